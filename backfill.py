@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the Backfill, which goes back over the recent history of
+a set of subreddits to reply to posts the bot missed, for instance after
+downtime or when a subreddit is newly watched.
+
+The subreddits are paged through newest first in multireddit groups, a full
+listing page per request, until posts are older than the start of the time
+range. Posts go through the bot's usual filters and are deduplicated against
+its seen store, so nothing is replied to twice. After every page the listing
+position of each group is saved to a checkpoint file, so an interrupted
+backfill resumes where it stopped.
+"""
+
+import json
+import logging
+import os
+from streams import chunk_subreddits
+import time
+
+__all__ = ['Backfill']
+
+log = logging.getLogger('OA_source_bot.backfill')
+
+
+class Backfill(object):
+    """
+    Pages through the submissions of `subreddits` made since `since` (a Unix
+    time), passing each listing page to `handle(posts)`, which returns the
+    number of them queued for a reply. A checkpoint for the same subreddits
+    is resumed, keeping its time range.
+    """
+    def __init__(self, reddit, subreddits, since, handle, checkpoint_path,
+                 page_size=100, max_length=1500):
+        self.reddit = reddit
+        self.subreddits = sorted(set(subreddits))
+        self.since = since
+        self.handle = handle
+        self.checkpoint_path = checkpoint_path
+        self.page_size = page_size
+        self.groups = chunk_subreddits(self.subreddits, max_length)
+        self.progress = {group: {'after': None, 'done': False} for group in self.groups}
+        self.scanned = 0
+        self.queued = 0
+        self._load()
+
+    def run(self):
+        start = time.monotonic()
+        for group in self.groups:
+            while not self.progress[group]['done']:
+                self._page(group)
+                self._save()
+        log.info('Backfill complete: {0} posts scanned, {1} queued in {2:.0f}s'.format(self.scanned, self.queued, time.monotonic() - start))
+        if os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def _page(self, group):
+        state = self.progress[group]
+        params = {} if state['after'] is None else {'after': state['after']}
+        posts = list(self.reddit.get_subreddit(group).get_new(limit=self.page_size,
+                                                               params=params))
+        in_range = []
+        for post in posts:
+            if post.created_utc < self.since:
+                state['done'] = True
+                break
+            in_range.append(post)
+        if in_range:
+            self.scanned += len(in_range)
+            self.queued += self.handle(in_range)
+            state['after'] = in_range[-1].fullname
+        if len(posts) < self.page_size:  # Reached the end of the listing
+            state['done'] = True
+        log.info('Backfill of {0}: {1} posts scanned, {2} queued'.format(group if len(group) < 60 else group[:57] + '...', self.scanned, self.queued))
+
+    def _load(self):
+        if not os.path.isfile(self.checkpoint_path):
+            return
+        try:
+            with open(self.checkpoint_path) as inf:
+                checkpoint = json.load(inf)
+        except ValueError as e:
+            log.exception(e)
+            log.error('Backfill checkpoint is corrupt, starting over')
+            return
+        if checkpoint.get('subreddits') != self.subreddits:
+            log.info('Backfill checkpoint is for other subreddits, starting over')
+            return
+        #The time range is kept from the start of the interrupted backfill
+        self.since = checkpoint['since']
+        for group, state in checkpoint['progress'].items():
+            if group in self.progress:
+                self.progress[group] = state
+        self.scanned = checkpoint.get('scanned', 0)
+        self.queued = checkpoint.get('queued', 0)
+        log.info('Resuming backfill from {0}'.format(self.checkpoint_path))
+
+    def _save(self):
+        checkpoint = {'subreddits': self.subreddits,
+                      'since': self.since,
+                      'progress': self.progress,
+                      'scanned': self.scanned,
+                      'queued': self.queued}
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            json.dump(checkpoint, out, sort_keys=True)
+        os.replace(tmp_path, self.checkpoint_path)
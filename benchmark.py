@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+OA_source_bot benchmark
+
+Runs the bot offline against a fake reddit, a local publisher server and a
+stub openaccess_epub, then reports throughput, per-stage latency and memory, followed
+by microbenchmarks of the domain methods.
+
+Usage:
+  benchmark.py [--posts=N] [--mix=MIX] [--workers=N]
+               [--oaepub-latency=SECONDS] [--conversion-backend=BACKEND]
+               [--reddit-latency=SECONDS]
+               [--publisher-latency=SECONDS] [--log=MODE] [--capture=FILENAME]
+               [--trace-memory] [--micro-only]
+  benchmark.py --help
+
+Options:
+  -n --posts=N                  Number of synthetic submissions [default: 5000]
+  -m --mix=MIX                  Domain mix as comma separated kind=weight pairs
+                                [default: other=0.95,plos=0.02,nature_full_oa=0.01,nature_opt_oa=0.01,nature_closed=0.01]
+  -w --workers=N                Reply workers [default: 2]
+  --oaepub-latency=SECONDS      Time the stub conversion takes [default: 0.5]
+  --conversion-backend=BACKEND  Convert with the stub openaccess_epub library
+                                or the stub oaepub command, library or
+                                subprocess [default: library]
+  --reddit-latency=SECONDS      Time every fake reddit call takes [default: 0.05]
+  --publisher-latency=SECONDS   Time the publisher server takes [default: 0.02]
+  --log=MODE                    Bot logging during the run: none, plain or
+                                structured [default: none]
+  --capture=FILENAME            Record the synthetic submissions to a capture
+                                file, for oa_source_bot.py --replay
+  --trace-memory                Measure peak Python allocations (slower)
+  --micro-only                  Only run the microbenchmarks
+  -h --help                     Print this help message and exit
+"""
+
+from bot_utils import TTLCache
+from docopt import docopt
+from domains import DomainRegistry, NatureDomain, PLoSDomain
+from fakes import (FakeReddit, PublisherServer, install_stub_oaepub,
+                   install_stub_openaccess_epub, synthetic_stream)
+import logging
+from metrics import metrics
+from oa_source_bot import OASourceBot, logging_config
+import os
+import resource
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+
+class BenchNatureDomain(NatureDomain):
+    """
+    NatureDomain answering for the local publisher server, with its own cache.
+    """
+    hosts = ('nature.com', '127.0.0.1')
+    access_cache = TTLCache(ttl=6 * 3600, maxsize=5000)
+
+
+class BenchPLoSDomain(PLoSDomain):
+    """
+    PLoSDomain fetching article sources from the local publisher server.
+    """
+    source_base = None
+
+    @classmethod
+    def source_url(self, match):
+        url = super(BenchPLoSDomain, self).source_url(match)
+        return self.source_base + url.split(match.url.netloc, 1)[1]
+
+
+def parse_mix(text):
+    mix = {}
+    for pair in text.split(','):
+        kind, weight = pair.split('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def make_config(workdir, backend):
+    dropbox = os.path.join(workdir, 'dropbox')
+    os.makedirs(dropbox)
+    return {'username': 'OA_source_bot',
+            'password': '',
+            'watched-subreddits-wikipage': 'public_lists/watched_subreddits',
+            'ignored-users-wikipage': 'public_lists/ignored_users',
+            'dropbox-index-url': 'http://localhost/',
+            'public-dropbox-dir': dropbox,
+            'bot-moderators': ['SavinaRoja'],
+            'log-dir': os.path.join(workdir, 'logs'),
+            'metrics-port': None,
+            'conversion-backend': backend}
+
+
+def bench_run(args, workdir, server):
+    reddit = FakeReddit(read_latency=float(args['--reddit-latency']),
+                        write_latency=float(args['--reddit-latency']))
+    subreddits = ['science', 'biology', 'pics', 'funny', 'news']
+    reddit.wiki[('OA_source_bot', 'public_lists/watched_subreddits')] = '\n'.join(
+        '    ' + sub for sub in subreddits[:2])
+    config = make_config(workdir, args['--conversion-backend'])
+    config['reply-workers'] = int(args['--workers'])
+    if args['--capture']:
+        config['capture-file'] = args['--capture']
+    count = int(args['--posts'])
+    posts = list(synthetic_stream(reddit, count, parse_mix(args['--mix']),
+                                  subreddits, nature_base=server.base))
+
+    bot = OASourceBot(config, reddit=reddit)
+    BenchPLoSDomain.source_base = server.base
+    bot.oa_domains = DomainRegistry([BenchPLoSDomain, BenchNatureDomain])
+    bot.submission_source = lambda: iter(posts)
+
+    if args['--trace-memory']:
+        tracemalloc.start()
+    bot.pipeline.start()
+    start = time.perf_counter()
+    bot._run()
+    streamed = time.perf_counter() - start
+    bot.pipeline.shutdown(drain=True)
+    bot.indexer.flush()
+    total = time.perf_counter() - start
+    bot.converter.shutdown()
+    bot.source_cache.shutdown()
+    if bot.capture is not None:
+        bot.capture.close()
+
+    print('== Run ==')
+    print('posts: {0}'.format(count))
+    print('stream: {0:.2f}s, {1:.0f} posts/s through _run'.format(streamed, count / streamed))
+    print('end to end: {0:.2f}s, {1:.0f} posts/s including replies'.format(total, count / total))
+    print('replies: {0}'.format(sum(1 for c in reddit.comments.values() if c.body != bot.temp_message)))
+    print('reddit calls: {0}'.format(', '.join('{0}={1}'.format(k, v) for k, v in sorted(reddit.calls.items()))))
+    print('publisher requests: {0}'.format(server.requests))
+    print('index regenerations: {0}'.format(bot.indexer.regenerations))
+    print('source cache: {0} hits, {1} prefetched, {2} misses, {3} bytes saved'.format(bot.source_cache.hits, bot.source_cache.prefetched, bot.source_cache.misses, bot.source_cache.bytes_saved))
+    print('max rss: {0:.1f} MiB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    if args['--trace-memory']:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('python allocations: {0:.1f} MiB current, {1:.1f} MiB peak'.format(current / 2 ** 20, peak / 2 ** 20))
+    print('== Stages ==')
+    for (name, labels), hist in sorted(metrics.histograms.items()):
+        label = ','.join('{0}={1}'.format(k, v) for k, v in labels)
+        print('{0:<16} {1:<40} n={2:<6} mean={3:.6f}s p95<={4}s max={5:.6f}s'.format(name, label, hist.count, hist.sum / hist.count, hist.quantile(0.95), hist.max))
+    print('== Filters ==')
+    for stats in bot.core_filters.stats():
+        print('{name:<10} evaluated={evaluations:<7} rejected={rejections:<7} {seconds:.4f}s'.format(**stats))
+
+
+def bench_micro(server, number=20000):
+    reddit = FakeReddit()
+    registry = DomainRegistry([PLoSDomain, BenchNatureDomain])
+    plos_post = next(synthetic_stream(reddit, 1, {'plos': 1}, ['science']))
+    plos = registry.classify(plos_post)
+    nature_post = next(synthetic_stream(reddit, 1, {'nature_opt_oa': 1}, ['science'],
+                                        nature_base=server.base))
+    nature = registry.classify(nature_post)
+
+    def uncached():
+        BenchNatureDomain.access_cache.invalidate(nature.key)
+        BenchNatureDomain.predicate(nature)
+
+    cases = [('registry.classify', lambda: registry.classify(plos_post), number),
+             ('PLoSDomain.pdf_url', lambda: PLoSDomain.pdf_url(plos), number),
+             ('PLoSDomain.doi', lambda: PLoSDomain.doi(plos), number),
+             ('NatureDomain.predicate cached', lambda: BenchNatureDomain.predicate(nature), number),
+             ('NatureDomain.predicate uncached', uncached, 200)]
+    print('== Microbenchmarks ==')
+    for name, func, count in cases:
+        func()  # Warm caches and connections
+        seconds = timeit.timeit(func, number=count)
+        print('{0:<32} {1:10.2f} us/call'.format(name, seconds / count * 1e6))
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--capture']:
+        args['--capture'] = os.path.abspath(args['--capture'])
+    listener = None
+    with tempfile.TemporaryDirectory(prefix='oa_bench-') as workdir:
+        os.chdir(workdir)
+        if args['--log'] == 'none':
+            logging.getLogger('OA_source_bot').setLevel(logging.WARNING)
+        else:
+            listener = logging_config(os.path.join(workdir, 'logs'), 'SILENT',
+                                      mode=args['--log'])
+        install_stub_oaepub(workdir, latency=float(args['--oaepub-latency']))
+        install_stub_openaccess_epub(workdir, latency=float(args['--oaepub-latency']))
+        server = PublisherServer(latency=float(args['--publisher-latency'])).start()
+        try:
+            if not args['--micro-only']:
+                bench_run(args, workdir, server)
+            server.latency = 0
+            bench_micro(server)
+        finally:
+            server.stop()
+            if listener is not None:
+                listener.stop()
+
+
+if __name__ == '__main__':
+    main()
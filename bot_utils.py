@@ -1,20 +1,204 @@
 # -*- coding: utf-8 -*-
 
-from functools import wraps
+import _thread
+from collections import OrderedDict
+import heapq
+import logging
+import random
+import threading
 import time
 
+log = logging.getLogger('OA_source_bot.bot_utils')
 
-def timer(t):
+_MISSING = object()
+
+
+class PeriodicJob(object):
+    """
+    A function to be run every `interval` seconds, with its run statistics.
+    Runs are due on an unjittered schedule, `base`, and each is delayed from
+    it by up to `jitter` seconds, so jitter spreads the runs out without
+    slowing them down.
+    """
+    def __init__(self, name, func, interval, jitter=0.0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.base = 0.0
+        self.next_run = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.missed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.max_lateness = 0.0
+
+    def __lt__(self, other):
+        return self.next_run < other.next_run
+
+    def schedule(self, base):
+        """
+        Set the next run due at `base`, plus up to `jitter` random seconds.
+        """
+        self.base = base
+        self.next_run = base + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def schedule_after(self, now):
+        """
+        Set the next run one interval after the last one was due, counting
+        any intervals that have already passed as missed.
+        """
+        base = self.base + self.interval
+        if base < now:
+            skipped = int((now - base) // self.interval) + 1
+            self.missed += skipped
+            log.warning('Job {0} missed {1} deadline(s)'.format(self.name, skipped))
+            base += skipped * self.interval
+        self.schedule(base)
+
+    def stats(self):
+        return {'name': self.name,
+                'interval': self.interval,
+                'runs': self.runs,
+                'failures': self.failures,
+                'missed': self.missed,
+                'mean_seconds': self.total_seconds / self.runs if self.runs else 0.0,
+                'max_seconds': self.max_seconds,
+                'max_lateness': self.max_lateness}
+
+
+class PeriodicScheduler(object):
     """
-    Function decorator that enforces a time interval between function calls.
+    Runs periodic jobs from a heap ordered by next run time, on a monotonic
+    clock, in a worker thread of its own so that they never block the stream.
+    Jobs run one at a time, so a job never overlaps with itself.
+
+    If given, `observer(job, seconds)` is called after every run.
     """
-    def wrapper(f):
-        @wraps(f)
-        def wrapped_func(*args, **kwargs):
-            now = time.time()
-            if now - wrapped_func.latest > t:
-                f(*args, **kwargs)
-                wrapped_func.latest = now
-        wrapped_func.latest = time.time()
-        return wrapped_func
-    return wrapper
\ No newline at end of file
+    def __init__(self, name='scheduler', observer=None):
+        self.name = name
+        self.observer = observer
+        self.jobs = []
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def add(self, name, func, interval, jitter=0.0, delay=None):
+        """
+        Schedule `func` every `interval` seconds, first after `delay` seconds
+        (one interval by default), plus up to `jitter` random seconds.
+        """
+        job = PeriodicJob(name, func, interval, jitter)
+        job.schedule(time.monotonic() + (interval if delay is None else delay))
+        with self._cond:
+            self.jobs.append(job)
+            heapq.heappush(self._heap, job)
+            self._cond.notify()
+        return job
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name=self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0].next_run <= now:
+                        break
+                    timeout = self._heap[0].next_run - now if self._heap else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                job = heapq.heappop(self._heap)
+            self._run_job(job)
+            with self._cond:
+                job.schedule_after(time.monotonic())
+                heapq.heappush(self._heap, job)
+
+    def _run_job(self, job):
+        start = time.monotonic()
+        job.max_lateness = max(job.max_lateness, start - job.next_run)
+        try:
+            job.func()
+        except KeyboardInterrupt:
+            #Jobs may request a shutdown the same way the console does
+            log.info('Job {0} requested shutdown'.format(job.name))
+            _thread.interrupt_main()
+        except Exception as e:
+            job.failures += 1
+            log.exception(e)
+        finally:
+            elapsed = time.monotonic() - start
+            job.runs += 1
+            job.total_seconds += elapsed
+            job.max_seconds = max(job.max_seconds, elapsed)
+            log.debug('Job {0} took {1:.2f}s'.format(job.name, elapsed))
+            if self.observer is not None:
+                self.observer(job, elapsed)
+
+    def stats(self):
+        return [job.stats() for job in self.jobs]
+
+    def report(self):
+        for stats in self.stats():
+            log.info('Job {name}: {runs} runs, {failures} failed, {missed} missed, '
+                     'mean {mean_seconds:.2f}s, max {max_seconds:.2f}s, '
+                     'max late {max_lateness:.2f}s'.format(**stats))
+
+
+class TTLCache(object):
+    """
+    A small thread-safe mapping whose entries expire `ttl` seconds after they
+    were set. If `maxsize` is given, the oldest entries are dropped to make
+    room for new ones.
+    """
+    def __init__(self, ttl, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic() + ttl, value)
+            while self.maxsize is not None and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
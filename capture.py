@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the capture format, in which the submissions the bot
+streams are recorded so that a stretch of real traffic can be replayed
+offline through the filters and domain predicates.
+
+A capture is an append-only file with one compact JSON array per line,
+holding only the fields the filters and domains read:
+
+    ["id", "subreddit", "author", "domain", "url", created_utc]
+
+The author is null for deleted posts. Captures are read a line at a time, so
+one of several gigabytes replays in constant memory, and a line left
+truncated by a crash mid-write is skipped.
+"""
+
+from collections import namedtuple
+import json
+import logging
+import threading
+import time
+
+__all__ = ['CapturedSubmission', 'CaptureWriter', 'paced', 'read_capture']
+
+log = logging.getLogger('OA_source_bot.capture')
+
+CapturedAuthor = namedtuple('CapturedAuthor', ['name'])
+CapturedSubreddit = namedtuple('CapturedSubreddit', ['display_name'])
+
+
+class CapturedSubmission(object):
+    """
+    A submission read back from a capture, with the attributes of a praw
+    Submission that the bot's filters and domains use.
+    """
+    __slots__ = ('id', 'subreddit', 'author', 'domain', 'url', 'created_utc')
+
+    def __init__(self, post_id, subreddit, author, domain, url, created_utc):
+        self.id = post_id
+        self.subreddit = CapturedSubreddit(subreddit)
+        self.author = None if author is None else CapturedAuthor(author)
+        self.domain = domain
+        self.url = url
+        self.created_utc = created_utc
+
+    @property
+    def fullname(self):
+        return 't3_' + self.id
+
+
+class CaptureWriter(object):
+    """
+    Appends the submissions passed to `record` to the capture file at `path`,
+    flushing every `flush_every` submissions and on `close`.
+    """
+    def __init__(self, path, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.recorded = 0
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def record(self, post):
+        author = None if post.author is None else post.author.name
+        line = json.dumps([post.id, post.subreddit.display_name, author,
+                           post.domain, post.url, post.created_utc],
+                          separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self.recorded += 1
+            if self.recorded % self.flush_every == 0:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        log.info('Captured {0} submissions to {1}'.format(self.recorded, self.path))
+
+
+def read_capture(path):
+    """
+    Yields the submissions of the capture file at `path`, in recorded order.
+    """
+    with open(path) as inf:
+        for line in inf:
+            try:
+                fields = json.loads(line)
+            except ValueError:
+                log.warning('Skipping unreadable line in {0}'.format(path))
+                continue
+            yield CapturedSubmission(*fields)
+
+
+def paced(posts, speed=None):
+    """
+    Yields `posts` spaced out as they were created, at `speed` times real
+    time. Without a speed they are yielded as fast as they are consumed.
+    """
+    if not speed:
+        yield from posts
+        return
+    first = None
+    start = time.monotonic()
+    for post in posts:
+        if first is None:
+            first = post.created_utc
+        delay = (post.created_utc - first) / speed - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+        yield post
@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+"""
+This module lets several bot processes, on one host or on several hosts
+sharing a filesystem, work side by side as a cluster.
+
+The workers share a SQLite database, whose file locks serialise their writes:
+
+* SharedSeenStore stands in for the SeenStore. Adding a post is an atomic
+  claim, so of several workers seeing the same post only one replies.
+* SharedJobJournal stands in for the JobJournal. Jobs belong to the worker
+  that claimed them; when a worker stops heartbeating its unfinished jobs are
+  adopted by the leader and resumed. A worker only updates jobs it still
+  owns, so one that was dropped cannot finish a job it has lost.
+* SharedOutputStore and SharedIndexGenerator keep the manifests of the
+  public dropbox directory, which workers on one host publish to together,
+  so that quota eviction and the index pages cover every worker's files.
+* Cluster keeps each worker's heartbeat, on a thread of its own so that no
+  other work can delay it, splits the watched subreddits between the live
+  workers with a consistent HashRing, and holds the lease that elects the
+  one worker (the leader) running the maintenance jobs.
+
+The database uses SQLite's default rollback journal rather than WAL, as WAL
+does not work over network filesystems.
+"""
+
+from bisect import bisect
+from contextlib import contextmanager
+import hashlib
+from indexer import IndexGenerator
+import json
+import logging
+import os
+from output_store import OutputStore
+from seen_store import SeenStore
+import sqlite3
+import threading
+import time
+
+__all__ = ['Cluster', 'HashRing', 'SharedIndexGenerator', 'SharedJobJournal',
+           'SharedOutputStore', 'SharedSeenStore', 'SharedState']
+
+log = logging.getLogger('OA_source_bot.cluster')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS seen (
+    post INTEGER PRIMARY KEY,
+    seen_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS seen_by_time ON seen (seen_at);
+CREATE TABLE IF NOT EXISTS jobs (
+    post TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    started REAL NOT NULL,
+    state TEXT NOT NULL,
+    comment_id TEXT,
+    epubs TEXT);
+CREATE INDEX IF NOT EXISTS jobs_by_owner ON jobs (owner);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS outputs (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_served REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS outputs_by_use ON outputs (last_served);
+CREATE TABLE IF NOT EXISTS index_files (
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (directory, name));
+'''
+
+
+class SharedState(object):
+    """
+    The SQLite database at `path`, with a connection for each thread.
+    """
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            #Autocommit, transactions are begun explicitly where needed
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the database's write lock for the with block.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+class SharedSeenStore(object):
+    """
+    The record of seen posts, shared by all workers. Supports the SeenStore
+    operations the bot uses.
+    """
+    pack_id = staticmethod(SeenStore.pack_id)
+    unpack_id = staticmethod(SeenStore.unpack_id)
+
+    def __init__(self, state, retention=7 * 24 * 3600):
+        self.state = state
+        self.retention = retention
+
+    def __contains__(self, post_id):
+        cursor = self.state.execute('SELECT 1 FROM seen WHERE post = ?',
+                                    (self.pack_id(post_id),))
+        return cursor.fetchone() is not None
+
+    def __len__(self):
+        return self.state.execute('SELECT count(*) FROM seen').fetchone()[0]
+
+    def add(self, post_id, when=None):
+        """
+        Claim a post ID for this worker. Returns False if it was already
+        present, whichever worker added it.
+        """
+        when = time.time() if when is None else when
+        cursor = self.state.execute('INSERT OR IGNORE INTO seen VALUES (?, ?)',
+                                    (self.pack_id(post_id), when))
+        return cursor.rowcount == 1
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        self.state.execute('DELETE FROM seen WHERE seen_at < ?',
+                           (now - self.retention,))
+
+    def compact(self):
+        self.expire()
+
+    def close(self):
+        pass
+
+
+class SharedJobJournal(object):
+    """
+    The reply jobs of all workers, supporting the JobJournal operations for
+    the jobs that belong to `owner`.
+    """
+    def __init__(self, state, owner, max_age=24 * 3600):
+        self.state = state
+        self.owner = owner
+        self.max_age = max_age
+        self.compact()
+
+    def __contains__(self, post_id):
+        return self.get(post_id) is not None
+
+    def __len__(self):
+        cursor = self.state.execute('SELECT count(*) FROM jobs WHERE owner = ?',
+                                    (self.owner,))
+        return cursor.fetchone()[0]
+
+    def owns(self, post_id):
+        """
+        True if the job for `post_id` is still this worker's.
+        """
+        cursor = self.state.execute('SELECT owner FROM jobs WHERE post = ?',
+                                    (post_id,))
+        row = cursor.fetchone()
+        return row is not None and row[0] == self.owner
+
+    def get(self, post_id):
+        cursor = self.state.execute('SELECT state, started, comment_id, epubs '
+                                    'FROM jobs WHERE post = ?', (post_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        job = {'state': row[0], 'started': row[1]}
+        if row[2] is not None:
+            job['comment_id'] = row[2]
+        if row[3] is not None:
+            job['epubs'] = {int(v): path for v, path in json.loads(row[3]).items()}
+        return job
+
+    def unfinished(self):
+        cursor = self.state.execute('SELECT post FROM jobs WHERE owner = ? '
+                                    'ORDER BY started', (self.owner,))
+        return [row[0] for row in cursor]
+
+    def has_placeholder(self, comment_id):
+        cursor = self.state.execute('SELECT 1 FROM jobs WHERE comment_id = ?',
+                                    (comment_id,))
+        return cursor.fetchone() is not None
+
+    def start(self, post_id):
+        self.state.execute('INSERT OR REPLACE INTO jobs (post, owner, started, state) '
+                           'VALUES (?, ?, ?, ?)',
+                           (post_id, self.owner, time.time(), 'queued'))
+
+    def placeholder(self, post_id, comment_id):
+        self.state.execute('UPDATE jobs SET state = ?, comment_id = ? '
+                           'WHERE post = ? AND owner = ?',
+                           ('placeholder', comment_id, post_id, self.owner))
+
+    def converted(self, post_id, epubs):
+        self.state.execute('UPDATE jobs SET state = ?, epubs = ? '
+                           'WHERE post = ? AND owner = ?',
+                           ('converted', json.dumps(epubs), post_id, self.owner))
+
+    def edited(self, post_id):
+        self.state.execute('DELETE FROM jobs WHERE post = ? AND owner = ?',
+                           (post_id, self.owner))
+
+    abandon = edited
+
+    def adopt(self, ttl):
+        """
+        Take over the jobs of workers that have not sent a heartbeat within
+        `ttl` seconds. Returns the post IDs adopted.
+        """
+        live = 'SELECT worker FROM workers WHERE heartbeat >= ?'
+        with self.state.transaction() as conn:
+            cutoff = time.time() - ttl
+            cursor = conn.execute('SELECT post FROM jobs WHERE owner NOT IN ({0})'.format(live),
+                                  (cutoff,))
+            adopted = [row[0] for row in cursor]
+            conn.execute('UPDATE jobs SET owner = ? WHERE owner NOT IN ({0})'.format(live),
+                         (self.owner, cutoff))
+        return adopted
+
+    def compact(self):
+        cursor = self.state.execute('DELETE FROM jobs WHERE started < ?',
+                                    (time.time() - self.max_age,))
+        if cursor.rowcount:
+            log.info('Abandoned {0} stale reply jobs'.format(cursor.rowcount))
+
+    def close(self):
+        pass
+
+
+class SharedOutputStore(OutputStore):
+    """
+    The output store of all workers, supporting the OutputStore operations.
+    Files are served and evicted least recently used across the workers. A
+    local manifest left from before worker mode is imported once.
+    """
+    def __init__(self, state, root, quota=None, manifest_path='output_store.json'):
+        self.state = state
+        super(SharedOutputStore, self).__init__(root, quota=quota,
+                                                manifest_path=manifest_path)
+
+    @property
+    def total_size(self):
+        return self.state.execute('SELECT coalesce(sum(size), 0) FROM outputs').fetchone()[0]
+
+    def lookup(self, doi, version):
+        key = self.key(doi, version)
+        row = self.state.execute('SELECT path FROM outputs WHERE key = ?', (key,)).fetchone()
+        if row is not None and not os.path.isfile(os.path.join(self.root, row[0])):
+            log.warning('Stored file {0} has gone missing'.format(row[0]))
+            self.state.execute('DELETE FROM outputs WHERE key = ?', (key,))
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.state.execute('UPDATE outputs SET last_served = ? WHERE key = ?',
+                           (time.time(), key))
+        log.info('Output store hit for doi:{0} EPUB{1}'.format(doi, version))
+        return row[0]
+
+    def has(self, doi, version):
+        cursor = self.state.execute('SELECT 1 FROM outputs WHERE key = ?',
+                                    (self.key(doi, version),))
+        return cursor.fetchone() is not None
+
+    def add(self, doi, version, path):
+        size = os.path.getsize(os.path.join(self.root, path))
+        key = self.key(doi, version)
+        with self.state.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)',
+                         (key, path, size, time.time()))
+            return self._evict_shared(conn, keep=key)
+
+    def report(self):
+        count, size = self.state.execute('SELECT count(*), coalesce(sum(size), 0) '
+                                         'FROM outputs').fetchone()
+        log.info('Output store: {0} files, {1} bytes, {2} hits, {3} misses, {4} evictions'.format(count, size, self.hits, self.misses, self.evictions))
+
+    def _evict_shared(self, conn, keep=None):
+        evicted = []
+        if self.quota is None:
+            return evicted
+        total = conn.execute('SELECT coalesce(sum(size), 0) FROM outputs').fetchone()[0]
+        by_age = conn.execute('SELECT key, path, size FROM outputs '
+                              'ORDER BY last_served').fetchall()
+        for key, path, size in by_age:
+            if total <= self.quota:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.root, path))
+            except FileNotFoundError:
+                pass
+            conn.execute('DELETE FROM outputs WHERE key = ?', (key,))
+            total -= size
+            self.evictions += 1
+            evicted.append(path)
+            log.info('Evicted {0} ({1} bytes) from the output store'.format(path, size))
+        return evicted
+
+    def _load(self):
+        if self.state.execute('SELECT 1 FROM outputs LIMIT 1').fetchone() is not None:
+            return
+        super(SharedOutputStore, self)._load()
+        if self.entries:
+            log.info('Importing {0} files from {1}'.format(len(self.entries), self.manifest_path))
+            with self.state.transaction() as conn:
+                conn.executemany('INSERT OR IGNORE INTO outputs VALUES (?, ?, ?, ?)',
+                                 [(key, entry['path'], entry['size'], entry['last_served'])
+                                  for key, entry in self.entries.items()])
+            self.entries = {}
+
+    def _save(self):
+        pass
+
+
+class SharedIndexGenerator(IndexGenerator):
+    """
+    The IndexGenerator of all workers, its manifest kept in the shared
+    database so that every worker's index pages list every worker's files.
+    """
+    def __init__(self, state, root, batch_delay=5.0):
+        self.state = state
+        super(SharedIndexGenerator, self).__init__(root, batch_delay=batch_delay)
+
+    def listing(self, directory):
+        cursor = self.state.execute('SELECT name, size, mtime FROM index_files '
+                                    'WHERE directory = ?', (directory,))
+        listing = {name: [size, mtime] for name, size, mtime in cursor}
+        cursor = self.state.execute('SELECT DISTINCT directory FROM index_files')
+        subdirs = set()
+        for (d,) in cursor:
+            #Directories holding only subdirectories have no rows of their own
+            while d and os.path.dirname(d) != directory:
+                d = os.path.dirname(d)
+            if d:
+                subdirs.add(d)
+        return listing, sorted(subdirs)
+
+    def _replace(self, entries):
+        with self.state.transaction() as conn:
+            conn.execute('DELETE FROM index_files')
+            conn.executemany('INSERT INTO index_files VALUES (?, ?, ?, ?)',
+                             [(directory, name, size, mtime)
+                              for directory, listing in entries.items()
+                              for name, (size, mtime) in listing.items()])
+
+    def _record(self, directory, name, stat):
+        with self.state.transaction() as conn:
+            new = conn.execute('SELECT 1 FROM index_files WHERE directory = ? LIMIT 1',
+                               (directory,)).fetchone() is None
+            conn.execute('INSERT OR REPLACE INTO index_files VALUES (?, ?, ?, ?)',
+                         (directory, name, stat[0], stat[1]))
+        return new
+
+    def _discard(self, directory, name):
+        cursor = self.state.execute('DELETE FROM index_files WHERE directory = ? AND name = ?',
+                                    (directory, name))
+        return cursor.rowcount > 0
+
+    def _save(self):
+        pass
+
+    def _load(self):
+        return self.state.execute('SELECT 1 FROM index_files LIMIT 1').fetchone() is not None
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto `nodes`, each placed at `replicas` points
+    on the ring, so that a node joining or leaving moves only its share of
+    the keys.
+    """
+    def __init__(self, nodes=(), replicas=100):
+        self.nodes = sorted(nodes)
+        self.replicas = replicas
+        points = []
+        for node in self.nodes:
+            for i in range(replicas):
+                points.append((self._hash('{0}#{1}'.format(node, i)), node))
+        points.sort()
+        self._hashes = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, key):
+        """
+        Returns the node that `key` maps to, or None if there are no nodes.
+        """
+        if not self._nodes:
+            return None
+        index = bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class Cluster(object):
+    """
+    This worker's membership of the cluster. Workers that have not sent a
+    heartbeat within `lease_ttl` seconds are considered gone; the maintenance
+    lease likewise expires `lease_ttl` seconds after its last renewal.
+    """
+    lease_name = 'maintenance'
+
+    def __init__(self, state, worker_id, lease_ttl=90):
+        self.state = state
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.stale_after = lease_ttl  # Heartbeat age at which a worker's keys are taken over
+        self.members = []
+        self.ring = HashRing()
+        self.lease_expires = 0.0
+        self.joined = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, interval=30):
+        """
+        Send a heartbeat now and then every `interval` seconds from a thread
+        of its own. A worker that has missed two heartbeats counts as stale.
+        """
+        self.stale_after = min(self.lease_ttl, 2 * interval)
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._beat, args=(interval,),
+                                        name='cluster-heartbeat', daemon=True)
+        self._thread.start()
+
+    def _beat(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                log.exception(e)
+
+    def heartbeat(self):
+        """
+        Record this worker as alive, drop workers that have gone quiet,
+        refresh the ring and acquire or renew the maintenance lease. Returns
+        the workers that were dropped.
+        """
+        now = time.time()
+        with self.state.transaction() as conn:
+            present = conn.execute('SELECT 1 FROM workers WHERE worker = ?',
+                                   (self.worker_id,)).fetchone() is not None
+            conn.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)',
+                         (self.worker_id, now))
+            cursor = conn.execute('SELECT worker FROM workers WHERE heartbeat < ?',
+                                  (now - self.lease_ttl,))
+            gone = [row[0] for row in cursor]
+            conn.execute('DELETE FROM workers WHERE heartbeat < ?',
+                         (now - self.lease_ttl,))
+            members = sorted(row[0] for row in conn.execute('SELECT worker FROM workers'))
+        if self.joined and not present:
+            #Jobs this worker still holds may have been adopted meanwhile;
+            #SharedJobJournal.owns tells which are no longer its own
+            log.warning('Worker {0} had been dropped from the cluster, rejoining'.format(self.worker_id))
+        self.joined = True
+        for worker in gone:
+            log.info('Worker {0} stopped heartbeating, dropping it'.format(worker))
+        with self._lock:
+            if members != self.members:
+                log.info('Cluster members: {0}'.format(', '.join(members)))
+                self.members = members
+                self.ring = HashRing(members)
+        self.acquire_lease()
+        return gone
+
+    def acquire_lease(self):
+        """
+        Take the maintenance lease if it is free or expired, or renew it if
+        held. Returns True if this worker holds it.
+        """
+        now = time.time()
+        with self.state.transaction() as conn:
+            row = conn.execute('SELECT holder, expires FROM leases WHERE name = ?',
+                               (self.lease_name,)).fetchone()
+            if row is None or row[0] == self.worker_id or row[1] < now:
+                conn.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                             (self.lease_name, self.worker_id, now + self.lease_ttl))
+                acquired = True
+            else:
+                acquired = False
+        was_leader = self.is_leader()
+        #Count the lease as held slightly less long than others will wait
+        self.lease_expires = now + self.lease_ttl * 0.9 if acquired else 0.0
+        if acquired and not was_leader:
+            log.info('Worker {0} acquired the maintenance lease'.format(self.worker_id))
+        elif was_leader and not acquired:
+            log.warning('Worker {0} lost the maintenance lease'.format(self.worker_id))
+        return acquired
+
+    def is_leader(self):
+        return time.time() < self.lease_expires
+
+    def owns(self, key):
+        """
+        True if `key`, such as a subreddit name, is this worker's to handle:
+        it maps to this worker, or to a worker that has gone stale but is
+        still on the ring, which would otherwise leave its keys unhandled
+        until the ring drops it. The shared seen store keeps two workers
+        taking over the same key from both replying.
+        """
+        with self._lock:
+            owner = self.ring.owner(key.lower())
+        if owner is None or owner == self.worker_id:
+            return True
+        return not self.is_alive(owner)
+
+    def is_alive(self, worker):
+        """
+        True if `worker` has sent a heartbeat within `stale_after` seconds.
+        """
+        row = self.state.execute('SELECT heartbeat FROM workers WHERE worker = ?',
+                                 (worker,)).fetchone()
+        return row is not None and row[0] >= time.time() - self.stale_after
+
+    def leave(self):
+        """
+        Leave the cluster, releasing the lease so another worker can take it
+        at once.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self.state.transaction() as conn:
+            conn.execute('DELETE FROM workers WHERE worker = ?', (self.worker_id,))
+            conn.execute('DELETE FROM leases WHERE name = ? AND holder = ?',
+                         (self.lease_name, self.worker_id))
+        self.lease_expires = 0.0
+        log.info('Worker {0} left the cluster'.format(self.worker_id))
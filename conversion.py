@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the ConversionExecutor, which runs EPUB conversions of
+articles in parallel.
+
+There are two backends. The 'library' backend calls openaccess_epub in a
+child process per article, downloading and parsing the article XML once and
+building every EPUB version from the same parsed document. The 'subprocess'
+backend runs the `oaepub` command once per version on a process pool, and is
+used when configured or when openaccess_epub cannot be imported.
+
+openaccess_epub writes its output into the current working directory, so
+every job is given its own scratch directory; this lets several articles, and
+both EPUB versions of one article, be converted at the same time without
+clobbering one another. A job of either backend that outlives the timeout is
+killed, so a hung conversion neither holds a worker nor delays shutdown.
+"""
+
+import glob
+import logging
+import importlib.util
+from metrics import metrics
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+__all__ = ['ConversionExecutor', 'convert_article_job', 'convert_job']
+
+BACKENDS = ('library', 'subprocess')
+
+log = logging.getLogger('OA_source_bot.conversion')
+
+
+def convert_job(doi, version, destination, timeout, scratch_root=None,
+                source=None):
+    """
+    Convert the article identified by `doi` to EPUB `version` (2 or 3) in a
+    fresh scratch directory and move the result to `destination`. If
+    `source` is the path of the article XML it is used instead of fetching
+    the article.
+
+    Returns a tuple of `destination`, or None if the conversion failed or did
+    not finish within `timeout` seconds, and the time taken in seconds.
+    """
+    start = time.perf_counter()
+    result = _convert(doi, version, destination, timeout, scratch_root, source)
+    return result, time.perf_counter() - start
+
+
+def _stage_source(source, scratch):
+    """
+    Copy the article XML into the scratch directory, keeping anything oaepub
+    writes beside its input out of the source cache.
+    """
+    staged = os.path.join(scratch, 'article.xml')
+    shutil.copyfile(source, staged)
+    return staged
+
+
+def _convert(doi, version, destination, timeout, scratch_root, source=None):
+    scratch = tempfile.mkdtemp(prefix='oaepub-{0}-'.format(version),
+                               dir=scratch_root)
+    try:
+        article = 'doi:' + doi if source is None else _stage_source(source, scratch)
+        try:
+            subprocess.run(['oaepub', 'convert', '-{0}'.format(version),
+                            article],
+                           cwd=scratch, check=True, timeout=timeout,
+                           stdout=subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            log.error('oaepub timed out after {0}s converting doi:{1} to EPUB{2}'.format(timeout, doi, version))
+            return None
+        except (subprocess.CalledProcessError, OSError) as e:
+            log.exception(e)
+            log.error('Unable to produce EPUB{0} for doi:{1}'.format(version, doi))
+            return None
+        return _deliver(scratch, doi, version, destination)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _deliver(scratch, doi, version, destination):
+    """
+    Move the EPUB produced in `scratch` to `destination`, returning it, or
+    None if there is none.
+    """
+    produced = glob.glob(os.path.join(scratch, '*.epub'))
+    if not produced:
+        log.error('oaepub produced no EPUB{0} for doi:{1}'.format(version, doi))
+        return None
+    dest_dir = os.path.dirname(destination)
+    if dest_dir and not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir, exist_ok=True)
+    shutil.move(produced[0], destination)
+    return destination
+
+
+def convert_article_job(doi, destinations, scratch_root=None, source=None):
+    """
+    Convert the article identified by `doi` to each EPUB version in
+    `destinations`, a dict mapping version to destination path, with the
+    openaccess_epub library. The article XML is downloaded, unless `source`
+    is the path of a copy, and parsed once.
+
+    Returns a tuple of a dict mapping version to the destination, or None
+    where the conversion failed, and a dict of the seconds taken by the
+    'fetch' and by each version.
+    """
+    from openaccess_epub.article import Article
+    from openaccess_epub.utils.epub import make_EPUB
+    from openaccess_epub.utils.inputs import doi_input
+
+    results = {version: None for version in destinations}
+    timings = {}
+    scratch = tempfile.mkdtemp(prefix='oaepub-', dir=scratch_root)
+    #Paths given relative to the bot's directory must survive the chdir
+    destinations = {version: os.path.abspath(destination)
+                    for version, destination in destinations.items()}
+    if source is not None:
+        source = os.path.abspath(source)
+    cwd = os.getcwd()
+    #Pool workers run one job at a time, so changing directory is safe
+    os.chdir(scratch)
+    try:
+        start = time.perf_counter()
+        try:
+            if source is None:
+                #doi_input saves the XML in the working directory and returns its root name
+                xml_path = doi_input('doi:' + doi) + '.xml'
+            else:
+                xml_path = _stage_source(source, scratch)
+            article = Article(xml_path)
+        except Exception as e:
+            log.exception(e)
+            log.error('Unable to fetch and parse doi:{0}'.format(doi))
+            return results, timings
+        finally:
+            timings['fetch'] = time.perf_counter() - start
+        for version, destination in sorted(destinations.items()):
+            start = time.perf_counter()
+            try:
+                made = make_EPUB(article, os.path.join(scratch, 'epub{0}'.format(version)),
+                                 xml_path, None, epub_version=version, batch=True)
+            except Exception as e:
+                log.exception(e)
+                made = False
+            if made is False:
+                log.error('Unable to produce EPUB{0} for doi:{1}'.format(version, doi))
+            else:
+                results[version] = _deliver(scratch, doi, version, destination)
+            timings[version] = time.perf_counter() - start
+        return results, timings
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _article_process(conn, doi, destinations, scratch_root, source):
+    """
+    Run convert_article_job in a child process, sending its result back over
+    the pipe `conn`.
+    """
+    try:
+        conn.send(convert_article_job(doi, destinations, scratch_root, source))
+    finally:
+        conn.close()
+
+
+class ConversionExecutor(object):
+    """
+    Runs conversion jobs, as many at once as there are cores unless `workers`
+    is given, with `backend` one of 'library' or 'subprocess'. Library jobs
+    each get a child process that is terminated if it outlives `timeout`;
+    subprocess jobs run on a process pool that is only created for the first
+    job, keeping it off the startup path.
+    """
+    def __init__(self, workers=None, timeout=300, scratch_root=None,
+                 backend='library'):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown conversion backend {0!r}'.format(backend))
+        if backend == 'library' and importlib.util.find_spec('openaccess_epub') is None:
+            log.warning('openaccess_epub is not importable, converting with the oaepub command')
+            backend = 'subprocess'
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.scratch_root = scratch_root
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._running = set()  # Library job processes
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def submit(self, doi, version, destination, source=None):
+        """
+        Schedule a single conversion, returning a Future for its result, a
+        tuple of the produced path or None and the seconds taken.
+        """
+        return self.pool.submit(convert_job, doi, version, destination,
+                                self.timeout, self.scratch_root, source)
+
+    def convert(self, doi, destinations, source=None):
+        """
+        Convert `doi` to each EPUB version in `destinations`, a dict mapping
+        version to destination path, concurrently, from the article XML at
+        `source` if given. Blocks until all are done and returns a dict
+        mapping version to the produced path or None.
+        """
+        if self.backend == 'library':
+            return self._convert_article(doi, destinations, source)
+        futures = {version: self.submit(doi, version, dest, source)
+                   for version, dest in destinations.items()}
+        results = {}
+        for version, future in futures.items():
+            try:
+                results[version], seconds = future.result()
+            except Exception as e:
+                log.exception(e)
+                results[version] = None
+            else:
+                metrics.observe('stage_seconds', seconds, stage='oaepub_convert',
+                                version=version)
+        return results
+
+    def _convert_article(self, doi, destinations, source=None):
+        with self._slots:
+            outcome = self._run_article_job(doi, destinations, source)
+        if outcome is None:
+            return {version: None for version in destinations}
+        results, timings = outcome
+        for step, seconds in timings.items():
+            if step == 'fetch':
+                metrics.observe('stage_seconds', seconds, stage='oaepub_fetch')
+            else:
+                metrics.observe('stage_seconds', seconds, stage='oaepub_convert',
+                                version=step)
+        return results
+
+    def _run_article_job(self, doi, destinations, source):
+        """
+        Run convert_article_job for `doi` in a child process, returning its
+        result, or None if it failed or was killed for outliving the timeout.
+        """
+        #Scratch directories of a killed job are removed from here
+        scratch = tempfile.mkdtemp(prefix='oaepub-job-', dir=self.scratch_root)
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_article_process,
+                                          args=(sender, doi, destinations,
+                                                scratch, source),
+                                          daemon=True)
+        with self._lock:
+            self._running.add(process)
+        try:
+            process.start()
+            sender.close()
+            if receiver.poll(self.timeout):
+                return receiver.recv()
+            log.error('Killed the conversion of doi:{0} after {1}s'.format(doi, self.timeout))
+        except EOFError:
+            log.error('Conversion of doi:{0} exited without a result'.format(doi))
+        except Exception as e:
+            log.exception(e)
+        finally:
+            if process.is_alive():
+                process.terminate()
+            if process.pid is not None:
+                process.join()
+            receiver.close()
+            with self._lock:
+                self._running.discard(process)
+            shutil.rmtree(scratch, ignore_errors=True)
+        return None
+
+    def shutdown(self, wait=True):
+        """
+        Shut down the pool. Without `wait`, running library jobs are
+        terminated rather than waited on.
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=wait)
+            if not wait:
+                for process in self._running:
+                    if process.is_alive():
+                        process.terminate()
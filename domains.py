@@ -4,19 +4,132 @@ This module defines the Domain class along with inheriting classes to provide
 support for domain-specific methods of providing source materials.
 """
 
+from bot_utils import TTLCache
+from collections import namedtuple
+import http.client
 import logging
-import lxml.html
+from metrics import metrics
 import re
-import urllib.error
-from urllib.parse import urlparse, urlunparse
-import urllib.request
+import threading
+from urllib.parse import quote, unquote, urljoin, urlparse, urlunparse
 
 
-__all__ = ['NatureDomain', 'PLoSDomain']
+__all__ = ['Classification', 'DomainRegistry', 'NatureDomain', 'PLoSDomain',
+           'registry']
 
 log = logging.getLogger('OA_source_bot.domains')
 
 
+class _HostConnections(threading.local):
+    """
+    Keep-alive connections, one per (scheme, host), for the current thread.
+    """
+    def __init__(self):
+        self.connections = {}
+
+    def get(self, scheme, netloc, timeout):
+        key = (scheme, netloc)
+        conn = self.connections.get(key)
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=timeout)
+            self.connections[key] = conn
+        return conn
+
+    def discard(self, scheme, netloc):
+        conn = self.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+_connections = _HostConnections()
+
+
+def _http_get(url, timeout=15, redirects=5):
+    """
+    Issue a GET over a pooled keep-alive connection, following redirects.
+    Returns (url, response); the caller must pass the response to
+    `_http_release` once done reading.
+    """
+    for attempt in range(redirects + 1):
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        conn = _connections.get(parsed.scheme, parsed.netloc, timeout)
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            #The server may have dropped an idle connection; retry once fresh
+            _connections.discard(parsed.scheme, parsed.netloc)
+            conn = _connections.get(parsed.scheme, parsed.netloc, timeout)
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                #Do not leave a half-used connection in the pool
+                _connections.discard(parsed.scheme, parsed.netloc)
+                raise
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader('Location')
+            _http_release(url, response)
+            if location is None:
+                break
+            url = urljoin(url, location)
+            continue
+        return url, response
+    raise http.client.HTTPException('Too many redirects for {0}'.format(url))
+
+
+def _http_release(url, response, drain_limit=65536):
+    """
+    Return a connection to the pool if what remains of the response is small
+    enough to drain cheaply; otherwise close it.
+    """
+    parsed = urlparse(url)
+    if response.will_close or response.length is None or response.length > drain_limit:
+        _connections.discard(parsed.scheme, parsed.netloc)
+    else:
+        response.read()
+
+
+def download(url, out, timeout=30, chunk_size=65536):
+    """
+    Copy the body of `url` into the binary file object `out` over a pooled
+    connection, returning the number of bytes written. Raises
+    http.client.HTTPException on an error status.
+    """
+    url, response = _http_get(url, timeout=timeout)
+    if response.status >= 400:
+        _http_release(url, response)
+        raise http.client.HTTPException('HTTP {0} fetching {1}'.format(response.status, url))
+    size = 0
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            out.write(chunk)
+            size += len(chunk)
+    except BaseException:
+        _connections.discard(urlparse(url).scheme, urlparse(url).netloc)
+        raise
+    _http_release(url, response)
+    return size
+
+
+class Classification(namedtuple('Classification',
+                                 ['post', 'domain', 'key', 'kind', 'url'])):
+    """
+    The result of classifying a post's URL: the Domain class that handles it,
+    the article key (the DOI where the domain has one), whether the link is to
+    the 'full' text or an 'abstract', and the parsed URL.
+    """
+    __slots__ = ()
+
+
 class Domain(object):
     """
     Defines the basic Domain code contract, really this is little more than a
@@ -26,37 +139,54 @@ class Domain(object):
     #If this is not true, don't worry about the 'doi' or
     #'file_basename_from_doi' methods
     oaepub_support = False
+    #Host suffixes handled by this domain; subdomains such as www. also match
+    hosts = ()
 
     def __init__(self):
         pass
 
     @classmethod
-    def predicate(self, post):
+    def classify(self, url):
         """
-        Returns True if the post's URL corresponds to an article, otherwise it
-        will return False.
+        Given the parsed URL of a post, return a (key, kind) tuple if it
+        corresponds to an article, otherwise None.
 
         Should distinguish between domain non-article URLs such as
-        http://www.plosbiology.org/static/contact (return False) and article
+        http://www.plosbiology.org/static/contact (return None) and article
         URLs such as http://www.plosbiology.org/article/info%3Adoi%2F10.1371%2Fjournal.pbio.1001812
-        (return True).
         """
         raise NotImplementedError
 
     @classmethod
-    def pdf_url(self, post):
+    def predicate(self, match):
+        """
+        Returns True if the classified article should be replied to, otherwise
+        it will return False.
+        """
+        return True
+
+    @classmethod
+    def pdf_url(self, match):
         """
         Returns a URL to the PDF of the article.
         """
         raise NotImplementedError
 
     @classmethod
-    def doi(self, post):
+    def doi(self, match):
         """
-        Returns the article DOI from the post's URL.
+        Returns the article DOI.
         """
         raise NotImplementedError
 
+    @classmethod
+    def source_url(self, match):
+        """
+        Returns a URL to the article's source XML, from which EPUBs are made,
+        or None if the domain does not provide one.
+        """
+        return None
+
     @classmethod
     def file_basename_from_doi(self, doi):
         """
@@ -68,37 +198,46 @@ class Domain(object):
 
 class PLoSDomain(Domain):
     oaepub_support = True  # At this time, only valid publisher
+    hosts = ('plosone.org', 'plosbiology.org', 'ploscompbiol.org',
+             'ploscollections.org', 'plosgenetics.org', 'plospathogens.org',
+             'plosntds.org', 'plosmedicine.org')
+    article_regex = re.compile(r'/article/info(?:%3A|:)doi(?:%2F|/)'
+                               r'(10\.1371(?:%2F|/)journal\.[^;&?#/]+)',
+                               re.IGNORECASE)
 
     def __init__(self):
         super(PLoSDomain, self).__init__()
 
     @classmethod
-    def predicate(self, post):
-        log.info('testing {0} against PLoS predicate'.format(post.id))
-        if '/article/info%3Adoi%2F10.1371%2Fjournal.' in post.url:
-            return True
-        else:
-            return False
+    def classify(self, url):
+        found = self.article_regex.search(url.path)
+        if found is None:
+            return None
+        return unquote(found.group(1)), 'full'
 
     @classmethod
-    def pdf_url(self, post):
+    def predicate(self, match):
+        log.debug('testing {0} against PLoS predicate'.format(match.post.id),
+                  extra={'event': 'predicate', 'post': match.post.id})
+        return True
+
+    @classmethod
+    def pdf_url(self, match):
         """
         Returns a URL to the PDF of the article.
         """
-        parsed = urlparse(post.url)
-        pdf_url = '{0}://{1}'.format(parsed.scheme, parsed.netloc)
-        pdf_url += '/article/fetchObjectAttachment.action?uri='
-        pdf_path = parsed.path.replace(':', '%3A').replace('/', '%2F')
-        pdf_path = pdf_path.split('article%2F')[1]
-        pdf_url += '{0}{1}'.format(pdf_path, '&representation=PDF')
-        return pdf_url
+        return '{0}://{1}/article/fetchObjectAttachment.action?uri=info%3Adoi%2F{2}&representation=PDF'.format(match.url.scheme, match.url.netloc, quote(match.key, safe=''))
 
     @classmethod
-    def doi(self, post):
+    def doi(self, match):
         """
         Returns the article DOI from the post's URL.
         """
-        return '/'.join(post.url.split('%2F')[1:]).split(';')[0]
+        return match.key
+
+    @classmethod
+    def source_url(self, match):
+        return '{0}://{1}/article/fetchObjectAttachment.action?uri=info%3Adoi%2F{2}&representation=XML'.format(match.url.scheme, match.url.netloc, quote(match.key, safe=''))
 
     @classmethod
     def file_basename_from_doi(self, doi):
@@ -110,12 +249,16 @@ class NatureDomain(Domain):
     Handles nature.com
     """
     oaepub_support = False
+    hosts = ('nature.com',)
+    #matches full article link or abstract
+    article_regex = re.compile(r'^/(?P<journal>[^/]+)/journal/v[^/]+/n[^/]+/'
+                               r'(?P<kind>full|abs)/(?P<article>[^/]+)\.html$')
     #Last updated on 29-4-2014 from information located here:
     #http://www.nature.com/libraries/open_access/oa_pub_models.html
     full_oa_subjournals = set(['bcj', 'cddis', 'ctg', 'cti', 'psp', 'emi',
                                'emm', 'hortres', 'hgv', 'ijos', 'lsa', 'mtm',
                                'mtna', 'am', 'nutd', 'oncsis', 'srep', 'tp'])
-    opt_oa_subjournals = set(['ajg', 'aps' 'bdj', 'bdc', 'bmt', 'cgt', 'cdd',
+    opt_oa_subjournals = set(['ajg', 'aps', 'bdj', 'bdc', 'bmt', 'cgt', 'cdd',
                               'cr', 'cmi', 'clpt', 'ejcn', 'ejhg', 'eye',
                               'gene', 'gt', 'gim', 'hdy', 'hr', 'icb', 'ijir',
                               'ijo', 'ismej', 'ja', 'jcbfm', 'jes', 'jhg',
@@ -126,46 +269,153 @@ class NatureDomain(Domain):
     def __init__(self):
         super(NatureDomain, self).__init__()
 
+    #Access status of opt-in OA articles, keyed by article
+    access_cache = TTLCache(ttl=6 * 3600, maxsize=5000)
+
     @classmethod
-    def predicate(self, post):
-        log.info('testing {0} against NAture predicate'.format(post.id))
-        #matches full article link or abstract
-        full_regex = 'www.nature.com/\S+/journal/v\S+/n\S+/full/\S+.html'
-        abst_regex = 'www.nature.com/\S+/journal/v\S+/n\S+/abs/\S+.html'
-        full = re.search(full_regex, post.url)
-        abst = re.search(abst_regex, post.url)
-        if full is None and abst is None:  # Not an article
-            return False
-        if full is not None:
-            full_url = post.url
-        else:
-            full_url = post.url.replace('/full/', '/abs/')
-        parsed_url = urlparse(full_url)
-        subjournal = parsed_url.path.split('/')[1]
+    def classify(self, url):
+        found = self.article_regex.match(url.path)
+        if found is None:  # Not an article
+            return None
+        kind = 'full' if found.group('kind') == 'full' else 'abstract'
+        #The key is always the path of the full text
+        key = url.path if kind == 'full' else url.path.replace('/abs/', '/full/')
+        return key, kind
+
+    @classmethod
+    def predicate(self, match):
+        log.debug('testing {0} against NAture predicate'.format(match.post.id),
+                  extra={'event': 'predicate', 'post': match.post.id})
+        subjournal = match.key.split('/')[1]
         if subjournal in self.full_oa_subjournals:
             return True
         if subjournal not in self.opt_oa_subjournals:
             return False
 
-        #We try to inspect the article's html to detect if access is limited
+        #The same article is often posted to several subreddits
+        accessible = self.access_cache.get(match.key)
+        if accessible is None:
+            full_url = urlunparse([match.url.scheme, match.url.netloc,
+                                   match.key, '', '', ''])
+            with metrics.timer('stage_seconds', stage='nature_http'):
+                accessible = self.fetch_access(full_url)
+            if accessible is None:  # Fetch failed, don't cache
+                return False
+            self.access_cache.set(match.key, accessible)
+        return accessible
+
+    @classmethod
+    def fetch_access(self, full_url):
+        """
+        Inspect the article's html to detect if access is limited. Returns
+        True if it is open, False if limited, None on failure.
+
+        The page is parsed incrementally and reading stops at the first title
+        heading, which is marked as an access-title on restricted articles.
+        """
         try:
-            page_html = urllib.request.urlopen(full_url)
-        except urllib.error.HTTPError as e:
+            url, response = _http_get(full_url)
+        except (http.client.HTTPException, OSError) as e:
             log.exception(e)
-            return False
-        doc = lxml.html.fromstring(page_html.read())
-        if doc.find(".//h1[@class='heading access-title entry-title']") is not None:
-            return False
-        else:
-            return True
+            return None
+        if response.status >= 400:
+            log.error('HTTP {0} fetching {1}'.format(response.status, url))
+            _http_release(url, response)
+            return None
+        import lxml.etree  # Only Nature needs lxml, so it loads on first use
+        parser = lxml.etree.HTMLPullParser(events=('start',))
+        accessible = True
+        try:
+            while True:
+                chunk = response.read(8192)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                done = False
+                for event, element in parser.read_events():
+                    if element.tag != 'h1':
+                        continue
+                    classes = (element.get('class') or '').split()
+                    if 'access-title' in classes:
+                        accessible = False
+                        done = True
+                        break
+                    if 'entry-title' in classes:
+                        done = True
+                        break
+                if done:
+                    break
+        except (http.client.HTTPException, OSError) as e:
+            log.exception(e)
+            _connections.discard(urlparse(url).scheme, urlparse(url).netloc)
+            return None
+        _http_release(url, response)
+        return accessible
 
     @classmethod
-    def pdf_url(self, post):
-        parsed_url = urlparse(post.url)
-        paths = parsed_url.path.split('/')
+    def pdf_url(self, match):
+        paths = match.key.split('/')
         paths[-2] = 'pdf'
         paths[-1] = paths[-1].rsplit('.')[0] + '.pdf'
         modified_path = '/'.join(paths)
-        return urlunparse([parsed_url.scheme, parsed_url.netloc,
-                           modified_path, parsed_url.params,
-                           parsed_url.query, parsed_url.fragment])
\ No newline at end of file
+        return urlunparse([match.url.scheme, match.url.netloc,
+                           modified_path, '', '', ''])
+
+
+class DomainRegistry(object):
+    """
+    Maps host names to the Domain classes that handle them, indexed by host
+    suffix, and classifies posts against them.
+    """
+    def __init__(self, domains=()):
+        self.suffixes = {}
+        for domain in domains:
+            self.register(domain)
+
+    def register(self, domain):
+        for host in domain.hosts:
+            self.suffixes[host.lower()] = domain
+
+    def lookup(self, host):
+        """
+        Return the Domain class for `host` or any of its parent domains, or
+        None if no registered domain handles it.
+        """
+        host = host.lower()
+        while True:
+            domain = self.suffixes.get(host)
+            if domain is not None:
+                return domain
+            dot = host.find('.')
+            if dot < 0:
+                return None
+            host = host[dot + 1:]
+
+    def __contains__(self, host):
+        return self.lookup(host) is not None
+
+    def classify(self, post):
+        """
+        Parse the post's URL once and return a Classification, or None if it
+        is not an article on a registered domain.
+        """
+        url = urlparse(post.url)
+        domain = self.lookup(url.hostname or post.domain)
+        if domain is None:
+            return None
+        result = domain.classify(url)
+        if result is None:
+            return None
+        key, kind = result
+        return Classification(post, domain, key, kind, url)
+
+    def classify_batch(self, posts):
+        """
+        Classify each of `posts`, returning a list of Classification or None
+        in the same order.
+        """
+        classify = self.classify
+        return [classify(post) for post in posts]
+
+
+registry = DomainRegistry([PLoSDomain, NatureDomain])
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides offline stand-ins for the services OA_source_bot talks
+to, for benchmarking and reproducing behaviour without logging into reddit.
+
+* FakeReddit and friends mimic the parts of the praw session, submissions,
+  comments and wikipages that OASourceBot uses, with configurable latency.
+* PublisherServer is a local HTTP server serving PLoS and Nature shaped
+  article pages.
+* install_stub_oaepub writes an `oaepub` script with configurable latency
+  that produces a small EPUB file.
+* install_stub_openaccess_epub writes an importable `openaccess_epub` package
+  with the same latency and output, for the library conversion backend.
+* synthetic_stream generates submissions with a configurable domain mix.
+"""
+
+from collections import namedtuple
+import http.server
+import itertools
+import os
+import random
+import stat
+import sys
+import threading
+import time
+
+__all__ = ['FakeComment', 'FakeReddit', 'FakeSubmission', 'PublisherServer',
+           'install_stub_oaepub', 'install_stub_openaccess_epub',
+           'synthetic_stream']
+
+FakeAuthor = namedtuple('FakeAuthor', ['name'])
+FakeSubreddit = namedtuple('FakeSubreddit', ['display_name'])
+
+_ids = itertools.count(36 ** 5)
+
+
+def _next_id():
+    number = next(_ids)
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    chars = []
+    while number:
+        number, rem = divmod(number, 36)
+        chars.append(digits[rem])
+    return ''.join(reversed(chars))
+
+
+class FakeComment(object):
+    def __init__(self, session, body, submission):
+        self.session = session
+        self.id = _next_id()
+        self.fullname = 't1_' + self.id
+        self.body = body
+        self.submission = submission
+        self.link_id = submission.fullname
+        self.author = FakeAuthor(session.username)
+        self.score = 1
+        self.created_utc = time.time()
+        self.edits = 0
+
+    def edit(self, text):
+        self.session.write_call('edit')
+        self.body = text
+        self.edits += 1
+
+    def delete(self):
+        self.session.write_call('delete')
+        self.author = None
+        self.session.comments.pop(self.id, None)
+
+
+class FakeSubmission(object):
+    def __init__(self, session, subreddit, author, domain, url, created_utc=None,
+                 post_id=None):
+        self.session = session
+        self.id = post_id or _next_id()
+        self.fullname = 't3_' + self.id
+        self.subreddit = FakeSubreddit(subreddit)
+        self.author = None if author is None else FakeAuthor(author)
+        self.domain = domain
+        self.url = url
+        self.created_utc = time.time() if created_utc is None else created_utc
+
+    @property
+    def comments(self):
+        return [c for c in self.session.comments.values() if c.submission is self]
+
+    def add_comment(self, text):
+        self.session.write_call('add_comment')
+        comment = FakeComment(self.session, text, self)
+        self.session.comments[comment.id] = comment
+        return comment
+
+
+class FakeWikiPage(object):
+    def __init__(self, session, key):
+        self.session = session
+        self.key = key
+        self.content_md = session.wiki.get(key, '')
+
+    def edit(self, content):
+        self.session.write_call('wiki_edit')
+        self.session.wiki[self.key] = content
+
+
+class FakeRedditor(object):
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+
+    def get_comments(self, sort='new', limit=None):
+        self.session.read_call('get_comments')
+        return list(self.session.comments.values())[:limit]
+
+    def mark_as_read(self, messages):
+        self.session.write_call('mark_as_read')
+
+
+class FakeSubredditListing(object):
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+
+    def get_new(self, limit=100, params=None):
+        self.session.read_call('get_new')
+        wanted = set(self.name.lower().split('+'))
+        posts = [post for post in reversed(self.session.submissions)
+                 if 'all' in wanted or post.subreddit.display_name.lower() in wanted]
+        after = (params or {}).get('after')
+        if after is not None:
+            fullnames = [post.fullname for post in posts]
+            posts = posts[fullnames.index(after) + 1:] if after in fullnames else []
+        return posts[:limit]
+
+    def get_moderators(self):
+        self.session.read_call('get_moderators')
+        return [FakeAuthor(name) for name in self.session.moderators.get(self.name, [])]
+
+
+class FakeReddit(object):
+    """
+    A stand-in for a logged-in praw.Reddit session. Every API call sleeps for
+    `read_latency` or `write_latency` seconds and is counted in `calls`.
+    """
+    def __init__(self, username='OA_source_bot', read_latency=0.0,
+                 write_latency=0.0):
+        self.username = username
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        self.calls = {}
+        self.comments = {}
+        self.submissions = []
+        self.wiki = {}
+        self.moderators = {}
+        self.unread = []
+        self._lock = threading.Lock()
+
+    def _call(self, name, latency):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if latency:
+            time.sleep(latency)
+
+    def read_call(self, name):
+        self._call(name, self.read_latency)
+
+    def write_call(self, name):
+        self._call(name, self.write_latency)
+
+    def login(self, username, password):
+        self.read_call('login')
+
+    def get_redditor(self, name):
+        self.read_call('get_redditor')
+        return FakeRedditor(self, name)
+
+    def get_wiki_page(self, owner, page):
+        self.read_call('get_wiki_page')
+        return FakeWikiPage(self, (owner, page))
+
+    def get_subreddit(self, name):
+        return FakeSubredditListing(self, name)
+
+    def get_unread(self, limit=None):
+        self.read_call('get_unread')
+        unread, self.unread = self.unread, []
+        return unread
+
+    def get_info(self, thing_id=None, **kwargs):
+        self.read_call('get_info')
+        ids = thing_id if isinstance(thing_id, list) else [thing_id]
+        found = []
+        for fullname in ids:
+            kind, _, short = fullname.partition('_')
+            if kind == 't1' and short in self.comments:
+                found.append(self.comments[short])
+            elif kind == 't3':
+                found.extend(post for post in self.submissions if post.id == short)
+        if isinstance(thing_id, list):
+            return found or None
+        return found[0] if found else None
+
+    def submit(self, submission):
+        """
+        Make a submission visible in listings.
+        """
+        self.submissions.append(submission)
+
+
+def synthetic_stream(session, count, mix, subreddits, watched_fraction=0.5,
+                     nature_base='http://www.nature.com', seed=0):
+    """
+    Generate `count` FakeSubmissions. `mix` maps a kind ('plos',
+    'nature_full_oa', 'nature_opt_oa', 'nature_closed', 'other') to its
+    relative weight; a `watched_fraction` of posts go to `subreddits[0]` and
+    the rest to other subreddits.
+    """
+    rng = random.Random(seed)
+    kinds = sorted(mix)
+    weights = [mix[kind] for kind in kinds]
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        number = rng.randrange(1000000, 9999999)
+        if kind == 'plos':
+            domain = 'plosone.org'
+            url = 'http://www.plosone.org/article/info%3Adoi%2F10.1371%2Fjournal.pone.{0}'.format(number)
+        elif kind == 'nature_full_oa':
+            domain = 'nature.com'
+            url = '{0}/srep/journal/v4/n1/full/srep{1}.html'.format(nature_base, number)
+        elif kind in ('nature_opt_oa', 'nature_closed'):
+            domain = 'nature.com'
+            marker = 'open' if kind == 'nature_opt_oa' else 'closed'
+            url = '{0}/ncomms/journal/v5/n1/full/{1}{2}.html'.format(nature_base, marker, number % 500)
+        else:
+            domain = 'example.com'
+            url = 'http://example.com/story/{0}'.format(number)
+        if rng.random() < watched_fraction:
+            subreddit = subreddits[0]
+        else:
+            subreddit = rng.choice(subreddits[1:] or ['unwatched'])
+        author = None if rng.random() < 0.01 else 'user{0}'.format(rng.randrange(5000))
+        yield FakeSubmission(session, subreddit, author, domain, url)
+
+
+class _QuietHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        #Clients hang up early on purpose once they have what they need
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(_QuietHTTPServer, self).handle_error(request, client_address)
+
+
+class PublisherServer(object):
+    """
+    A local HTTP/1.1 server with keep-alive serving article pages shaped like
+    those of PLoS and Nature. Nature paths containing 'closed' are served as
+    restricted-access pages.
+    """
+    def __init__(self, latency=0.0, padding=100000, host='127.0.0.1'):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                server.requests += 1
+                self.send_response(200)
+                body = server.page(self.path)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.latency = latency
+        self.padding = b'<p>' + b'lorem ipsum ' * (padding // 12) + b'</p>'
+        self.requests = 0
+        self.httpd = _QuietHTTPServer((host, 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def base(self):
+        host, port = self.httpd.server_address
+        return 'http://{0}:{1}'.format(host, port)
+
+    def page(self, path):
+        if 'closed' in path:
+            title = b'<h1 class="heading access-title entry-title">Access denied</h1>'
+        else:
+            title = b'<h1 class="heading entry-title">An article</h1>'
+        head = b'<html><head><title>Article</title>' + b'<meta name="x"/>' * 50 + b'</head><body>'
+        return head + title + self.padding + b'</body></html>'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+STUB_OAEPUB = '''\
+#!{python}
+import sys, time
+time.sleep({latency!r})
+doi = sys.argv[-1]
+name = doi.split('/')[-1] if '/' in doi else 'article'
+with open(name + '.epub', 'wb') as out:
+    out.write(b'PK' + b'0' * {size!r})
+'''
+
+
+def install_stub_oaepub(directory, latency=0.0, size=200000):
+    """
+    Write a stub `oaepub` executable into `directory` and put it first on the
+    PATH of this process and its children.
+    """
+    path = os.path.join(directory, 'oaepub')
+    with open(path, 'w') as out:
+        out.write(STUB_OAEPUB.format(python=sys.executable, latency=latency,
+                                     size=size))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ['PATH'] = directory + os.pathsep + os.environ.get('PATH', '')
+    return path
+
+
+STUB_OPENACCESS_EPUB = {
+    '__init__.py': '',
+    'article.py': '''\
+class Article(object):
+    def __init__(self, xml_file, validation=True):
+        with open(xml_file, 'rb') as inf:
+            self.xml = inf.read()
+''',
+    'utils/__init__.py': '',
+    'utils/inputs.py': '''\
+def doi_input(doi_string, download=True):
+    name = doi_string.split('/')[-1] if '/' in doi_string else 'article'
+    with open(name + '.xml', 'w') as out:
+        out.write('<article/>')
+    return name
+''',
+    'utils/epub.py': '''\
+import time
+
+
+def make_EPUB(parsed_article, output_directory, input_path, image_directory,
+              config_module=None, epub_version=None, batch=False):
+    time.sleep({latency!r})
+    with open(output_directory + '.epub', 'wb') as out:
+        out.write(b'PK' + b'0' * {size!r})
+    return True
+''',
+}
+
+
+def install_stub_openaccess_epub(directory, latency=0.0, size=200000):
+    """
+    Write a stub `openaccess_epub` package into `directory`, with the
+    functions the library conversion backend calls, and put it first on the
+    module search path of this process and its children.
+    """
+    package = os.path.join(directory, 'openaccess_epub')
+    for name, source in STUB_OPENACCESS_EPUB.items():
+        path = os.path.join(package, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as out:
+            out.write(source.format(latency=latency, size=size))
+    sys.path.insert(0, directory)
+    os.environ['PYTHONPATH'] = directory + os.pathsep + os.environ.get('PYTHONPATH', '')
+    return package
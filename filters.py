@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the FilterChain, an ordered series of cheap tests that a
+post must pass, such as OASourceBot.core_predicate.
+
+Every stage counts how often it is evaluated and how often it rejects. The
+chain periodically reorders its stages so that those which are cheap and
+likely to reject run first, which keeps the average cost per post low when
+filtering all of /r/all.
+"""
+
+import logging
+import time
+
+__all__ = ['FilterChain', 'FilterStage']
+
+log = logging.getLogger('OA_source_bot.filters')
+
+
+class FilterStage(object):
+    """
+    A named test which returns True if the item may pass. `cost` is a relative
+    estimate of how expensive the test is to evaluate.
+    """
+    def __init__(self, name, test, cost=1.0):
+        self.name = name
+        self.test = test
+        self.cost = cost
+        self.evaluations = 0
+        self.rejections = 0
+        self.seconds = 0.0
+
+    @property
+    def rejection_rate(self):
+        #Smoothed so that unevaluated stages start at one half
+        return (self.rejections + 1) / (self.evaluations + 2)
+
+    @property
+    def rank(self):
+        """
+        Expected cost paid per rejection; stages with a lower rank run first.
+        """
+        return self.cost / self.rejection_rate
+
+    def stats(self):
+        return {'name': self.name,
+                'cost': self.cost,
+                'evaluations': self.evaluations,
+                'rejections': self.rejections,
+                'rejection_rate': self.rejection_rate,
+                'seconds': self.seconds}
+
+
+class FilterChain(object):
+    """
+    Applies its stages in order, stopping at the first rejection. Every
+    `reorder_interval` calls the stages are re-sorted by rank.
+    """
+    def __init__(self, stages, reorder_interval=1000):
+        self.stages = list(stages)
+        self.reorder_interval = reorder_interval
+        self.calls = 0
+        self.passed = 0
+
+    def __call__(self, item):
+        self.calls += 1
+        if self.calls % self.reorder_interval == 0:
+            self.reorder()
+        clock = time.perf_counter
+        for stage in self.stages:
+            start = clock()
+            ok = stage.test(item)
+            stage.seconds += clock() - start
+            stage.evaluations += 1
+            if not ok:
+                stage.rejections += 1
+                return False
+        self.passed += 1
+        return True
+
+    def reorder(self):
+        order = sorted(self.stages, key=lambda stage: stage.rank)
+        if order != self.stages:
+            log.debug('Reordering filter stages: {0}'.format(', '.join(stage.name for stage in order)))
+            self.stages = order
+
+    def stats(self):
+        """
+        Returns a list of per-stage statistics in the current order.
+        """
+        return [stage.stats() for stage in self.stages]
+
+    def report(self):
+        log.info('Filter chain: {0} calls, {1} passed'.format(self.calls, self.passed))
+        for stage in self.stages:
+            log.info('  {0}: {1} evaluated, {2} rejected, {3:.3f}s'.format(stage.name, stage.evaluations, stage.rejections, stage.seconds))
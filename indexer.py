@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the IndexGenerator, which writes the index.html listings
+of the public dropbox directory in place of running pyndexer for every reply.
+
+A manifest of the listed files is kept in memory and on disk, and only the
+directories whose entries were added or removed are rewritten. Changes that
+arrive close together are batched into a single regeneration after a short
+delay, and every index is written atomically.
+"""
+
+import html
+import json
+import logging
+from metrics import metrics
+import os
+import threading
+import time
+
+__all__ = ['IndexGenerator']
+
+log = logging.getLogger('OA_source_bot.indexer')
+
+INDEX_NAME = 'index.html'
+
+PAGE = '''\
+<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Index of /{title}</title></head>
+<body>
+<h1>Index of /{title}</h1>
+<table>
+<tr><th>Name</th><th>Size</th><th>Modified (UTC)</th></tr>
+{rows}
+</table>
+</body>
+</html>
+'''
+
+ROW = '<tr><td><a href="{href}">{name}</a></td><td>{size}</td><td>{modified}</td></tr>'
+
+
+class IndexGenerator(object):
+    """
+    Maintains index.html files for the directories under `root`. Paths given
+    to `add` and `remove` are relative to `root`. The manifest is kept at
+    `manifest_path`, out of `root`, which is public.
+    """
+    def __init__(self, root, manifest_path='index_manifest.json', batch_delay=5.0):
+        self.root = root
+        self.manifest_path = manifest_path
+        self.batch_delay = batch_delay
+        self.entries = {}  # directory -> {name: [size, mtime]}
+        self.dirty = set()
+        self.regenerations = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        if not self._load():
+            self.scan()
+
+    def scan(self):
+        """
+        Rebuild the manifest from the files on disk and mark every directory
+        for regeneration.
+        """
+        log.info('Scanning {0} to build the index manifest'.format(self.root))
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            directory = os.path.relpath(dirpath, self.root)
+            directory = '' if directory == '.' else directory
+            listing = entries.setdefault(directory, {})
+            for filename in filenames:
+                if filename == INDEX_NAME or filename.startswith('.'):
+                    continue
+                stat = os.stat(os.path.join(dirpath, filename))
+                listing[filename] = [stat.st_size, stat.st_mtime]
+        with self._lock:
+            self._replace(entries)
+            self.dirty.update(entries)
+
+    def add(self, path):
+        full = os.path.join(self.root, path)
+        stat = os.stat(full)
+        directory, name = os.path.split(path)
+        with self._lock:
+            if self._record(directory, name, [stat.st_size, stat.st_mtime]):
+                self.dirty.add(os.path.dirname(directory))  # New subdirectory
+            self.dirty.add(directory)
+        self.request()
+
+    def remove(self, path):
+        directory, name = os.path.split(path)
+        with self._lock:
+            if not self._discard(directory, name):
+                return
+            self.dirty.add(directory)
+        self.request()
+
+    def listing(self, directory):
+        """
+        Returns the files listed in `directory`, mapped to [size, mtime], and
+        its subdirectories.
+        """
+        with self._lock:
+            listing = dict(self.entries.get(directory, {}))
+            subdirs = sorted(d for d in self.entries
+                             if d and os.path.dirname(d) == directory)
+        return listing, subdirs
+
+    def request(self):
+        """
+        Schedule a regeneration after the batch delay, unless one is already
+        pending.
+        """
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.batch_delay, self.regenerate)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """
+        Regenerate now if anything is pending, cancelling the batch timer.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+        self.regenerate()
+
+    def regenerate(self):
+        with self._lock:
+            self._timer = None
+            dirty, self.dirty = self.dirty, set()
+        if not dirty:
+            return
+        with metrics.timer('stage_seconds', stage='index'):
+            for directory in sorted(dirty):
+                self._write_index(directory, *self.listing(directory))
+            self._save()
+        self.regenerations += 1
+        log.info('Regenerated {0} index page(s)'.format(len(dirty)))
+
+    def _write_index(self, directory, listing, subdirs):
+        rows = []
+        for subdir in subdirs:
+            name = os.path.basename(subdir) + '/'
+            rows.append(ROW.format(href=html.escape(name), name=html.escape(name),
+                                   size='-', modified='-'))
+        for name in sorted(listing):
+            size, mtime = listing[name]
+            rows.append(ROW.format(href=html.escape(name), name=html.escape(name),
+                                   size=size,
+                                   modified=time.strftime('%Y-%m-%d %H:%M', time.gmtime(mtime))))
+        page = PAGE.format(title=html.escape(directory.replace(os.sep, '/')),
+                           rows='\n'.join(rows))
+        os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+        self._write_atomic(os.path.join(self.root, directory, INDEX_NAME), page)
+
+    @staticmethod
+    def _write_atomic(path, text):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write(text)
+        os.replace(tmp_path, path)
+
+    def _replace(self, entries):
+        self.entries = entries
+
+    def _record(self, directory, name, stat):
+        """
+        Add a file to the manifest, returning True if its directory is new.
+        """
+        new = directory not in self.entries
+        self.entries.setdefault(directory, {})[name] = stat
+        return new
+
+    def _discard(self, directory, name):
+        """
+        Drop a file from the manifest, returning False if it was not listed.
+        """
+        return self.entries.get(directory, {}).pop(name, None) is not None
+
+    def _save(self):
+        with self._lock:
+            manifest = json.dumps(self.entries, sort_keys=True)
+        self._write_atomic(self.manifest_path, manifest)
+
+    def _load(self):
+        if not os.path.isfile(self.manifest_path):
+            return False
+        try:
+            with open(self.manifest_path) as inf:
+                self.entries = json.load(inf)
+        except ValueError as e:
+            log.exception(e)
+            return False
+        return True
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the JobJournal, a durable record of the reply jobs the bot
+has accepted but not yet finished.
+
+Each step of a reply (accepted, comment posted, conversion done, finished)
+is appended to a journal file as a line of JSON as soon as it happens, so that
+after a crash or restart the unfinished jobs can be resumed from the last step
+they reached rather than redone or dropped. Finished jobs are dropped from the
+journal when it is compacted.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+__all__ = ['JobJournal']
+
+log = logging.getLogger('OA_source_bot.job_journal')
+
+QUEUED = 'queued'
+PLACEHOLDER = 'placeholder'
+CONVERTED = 'converted'
+EDITED = 'edited'
+ABANDONED = 'abandoned'
+FINISHED = (EDITED, ABANDONED)
+
+
+class JobJournal(object):
+    """
+    Maps post IDs of unfinished reply jobs to their state: a dict holding the
+    'state', the time the job was 'started', and where reached, the posted
+    comment's 'comment_id' and the 'epubs' mapping of EPUB version to
+    dropbox path (or None).
+
+    Jobs older than `max_age` seconds are abandoned when the journal is
+    loaded. The journal is rewritten once it holds more than `compact_ratio`
+    times as many records as there are unfinished jobs.
+    """
+    def __init__(self, path, max_age=24 * 3600, compact_ratio=4):
+        self.path = path
+        self.max_age = max_age
+        self.compact_ratio = compact_ratio
+        self._jobs = {}
+        self._journal_records = 0
+        self._lock = threading.Lock()
+        self._load()
+        self._journal = open(self.path, 'a')
+
+    def __contains__(self, post_id):
+        return post_id in self._jobs
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def get(self, post_id):
+        """
+        Returns a copy of the state of an unfinished job, or None.
+        """
+        with self._lock:
+            job = self._jobs.get(post_id)
+            return None if job is None else dict(job)
+
+    def unfinished(self):
+        """
+        Returns the post IDs of unfinished jobs, oldest first.
+        """
+        with self._lock:
+            return sorted(self._jobs, key=lambda i: self._jobs[i]['started'])
+
+    def owns(self, post_id):
+        """
+        Always True, as a single process never loses its jobs to another.
+        """
+        return True
+
+    def has_placeholder(self, comment_id):
+        """
+        True if `comment_id` is the placeholder of a job still in progress.
+        """
+        with self._lock:
+            return any(job.get('comment_id') == comment_id for job in self._jobs.values())
+
+    def start(self, post_id):
+        self._record(post_id, QUEUED, started=time.time())
+
+    def placeholder(self, post_id, comment_id):
+        self._record(post_id, PLACEHOLDER, comment_id=comment_id)
+
+    def converted(self, post_id, epubs):
+        self._record(post_id, CONVERTED, epubs=epubs)
+
+    def edited(self, post_id):
+        self._record(post_id, EDITED)
+
+    def abandon(self, post_id):
+        self._record(post_id, ABANDONED)
+
+    def compact(self):
+        """
+        Rewrite the journal so that it holds only the unfinished jobs.
+        """
+        with self._lock:
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            self._journal.close()
+
+    def _apply(self, record):
+        post_id = record.pop('id')
+        state = record['state']
+        if state in FINISHED:
+            self._jobs.pop(post_id, None)
+            return
+        job = self._jobs.setdefault(post_id, {'started': time.time()})
+        job.update(record)
+        if 'epubs' in record and record['epubs'] is not None:
+            #JSON object keys are strings, EPUB versions are ints
+            job['epubs'] = {int(v): path for v, path in record['epubs'].items()}
+
+    def _record(self, post_id, state, **fields):
+        record = dict(fields, id=post_id, state=state)
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            if post_id not in self._jobs and state != QUEUED:
+                return  # Finished, abandoned, or never journaled
+            self._apply(record)
+            self._journal.write(line + '\n')
+            self._journal.flush()
+            self._journal_records += 1
+            if self._journal_records > self.compact_ratio * max(len(self._jobs), 100):
+                self._compact()
+
+    def _compact(self):
+        log.debug('Compacting job journal, {0} records for {1} jobs'.format(self._journal_records, len(self._jobs)))
+        self._journal.close()
+        self._write_snapshot()
+        self._journal = open(self.path, 'a')
+
+    def _write_snapshot(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            for post_id, job in self._jobs.items():
+                out.write(json.dumps(dict(job, id=post_id), sort_keys=True) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.path)
+        self._journal_records = len(self._jobs)
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path) as inf:
+            for line in inf:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #A crash mid-write may leave a truncated last line
+                    log.warning('Discarding unreadable record in {0}'.format(self.path))
+                    continue
+                self._apply(record)
+        cutoff = time.time() - self.max_age
+        for post_id, job in list(self._jobs.items()):
+            if job['started'] < cutoff:
+                log.info('Abandoning stale reply job for post {0}'.format(post_id))
+                del self._jobs[post_id]
+        self._write_snapshot()
+        log.info('Loaded {0} unfinished reply jobs from {1}'.format(len(self._jobs), self.path))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides the pieces of the bot's structured logging mode, in which
+log records are handed through a queue to a background listener thread, so
+that the stream and reply threads never wait on file or console I/O.
+
+* QueueHandler renders each record's message on the logging thread and puts
+  it on the queue; the listener passes it on to the real handlers. The queue
+  is a multiprocessing one, so records logged in forked conversion processes
+  reach the listener too.
+* SamplingFilter rate-limits the high-frequency per-post debug events, those
+  logged with an 'event' in their extra fields, keeping every record at INFO
+  and above (replies, moderation, errors).
+* JSONFormatter writes each record as one compact line of JSON, including any
+  extra fields such as 'event' and 'post'.
+"""
+
+import copy
+import json
+import logging
+import logging.handlers
+from metrics import metrics
+import multiprocessing
+import threading
+import time
+
+__all__ = ['JSONFormatter', 'QueueHandler', 'SamplingFilter', 'start_listener']
+
+#The attributes every LogRecord has, anything else came in as an extra field
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as a line of JSON with its time, level, logger and
+    message, its extra fields, and the traceback if there is one.
+    """
+    def format(self, record):
+        entry = {'time': round(record.created, 3),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'msg': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through at most `rate` records a second, with bursts of up to
+    `burst`, of each per-post event: records below `level` that carry an
+    'event' extra field. Other records always pass. The next record let
+    through for an event counts those dropped since in its 'sampled_out'
+    field.
+    """
+    def __init__(self, rate=1.0, burst=None, level=logging.INFO):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+        self.burst = max(1.0, rate) if burst is None else burst
+        self.level = level
+        self._buckets = {}  # event -> [tokens, last refill, dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno >= self.level:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(event)
+            if bucket is None:
+                bucket = self._buckets[event] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                metrics.inc('log_records_sampled_out_total', event=event)
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.sampled_out = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue with their message and traceback rendered, but
+    without applying a formatter, so that each handler behind the listener
+    formats them its own way.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def start_listener(logger, handlers, sample_rate=None):
+    """
+    Route the records of `logger` through a queue to `handlers`, served by a
+    background thread, sampling per-post events to `sample_rate` a second if
+    given. Returns the started QueueListener; stop it to flush the queue.
+
+    Child processes forked afterwards inherit the QueueHandler, and their
+    records are passed back through the queue to this process's listener.
+    """
+    records = multiprocessing.Queue()
+    queue_handler = QueueHandler(records)
+    if sample_rate is not None:
+        queue_handler.addFilter(SamplingFilter(rate=sample_rate))
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(records, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines a small in-process metrics registry of counters, gauges
+and histograms, which can be served in the Prometheus text format on a local
+port and summarised in the log.
+
+Modules record into the shared `metrics` registry, for example:
+
+    with metrics.timer('stage_seconds', stage='core_predicate'):
+        ...
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+__all__ = ['Histogram', 'MetricsRegistry', 'MetricsServer', 'metrics']
+
+log = logging.getLogger('OA_source_bot.metrics')
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+class Histogram(object):
+    """
+    Counts observations into cumulative upper-bound buckets, keeping their
+    sum and maximum.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in.
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            if running >= target:
+                return bound
+        return self.max
+
+
+class MetricsRegistry(object):
+    """
+    Counters, gauges and histograms keyed by name and label values.
+    """
+    def __init__(self, prefix='oa_source_bot'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the time spent in the with block, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items())
+            typed = set()
+            for kind, items in (('counter', counters), ('gauge', gauges)):
+                for (name, labels), value in items:
+                    full = '{0}_{1}'.format(self.prefix, name)
+                    if full not in typed:
+                        lines.append('# TYPE {0} {1}'.format(full, kind))
+                        typed.add(full)
+                    lines.append('{0}{1} {2}'.format(full, self._format_labels(labels), value))
+            for (name, labels), hist in histograms:
+                full = '{0}_{1}'.format(self.prefix, name)
+                if full not in typed:
+                    lines.append('# TYPE {0} histogram'.format(full))
+                    typed.add(full)
+                running = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    running += count
+                    lines.append('{0}_bucket{1} {2}'.format(full, self._format_labels(labels, [('le', bound)]), running))
+                lines.append('{0}_bucket{1} {2}'.format(full, self._format_labels(labels, [('le', '+Inf')]), hist.count))
+                lines.append('{0}_sum{1} {2}'.format(full, self._format_labels(labels), hist.sum))
+                lines.append('{0}_count{1} {2}'.format(full, self._format_labels(labels), hist.count))
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        """
+        Log a one line summary of every histogram, counter and gauge.
+        """
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items()) + sorted(self.gauges.items())
+        for (name, labels), hist in histograms:
+            log.info('{0}{1}: n={2} mean={3:.3f}s p50<={4}s p95<={5}s max={6:.3f}s'.format(name, self._format_labels(labels), hist.count, hist.sum / hist.count if hist.count else 0.0, hist.quantile(0.5), hist.quantile(0.95), hist.max))
+        for (name, labels), value in counters:
+            log.info('{0}{1}: {2}'.format(name, self._format_labels(labels), value))
+
+
+class MetricsServer(object):
+    """
+    Serves a registry's metrics at /metrics on a local HTTP port, from a
+    daemon thread.
+    """
+    def __init__(self, registry, port, host='127.0.0.1'):
+        import http.server  # Loaded only when serving
+        self.registry = registry
+        registry_ref = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry_ref.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='metrics-server', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        log.info('Serving metrics on port {0}'.format(self.httpd.server_address[1]))
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+metrics = MetricsRegistry()
@@ -8,6 +8,12 @@ A reddit bot for the automatic provision of OpenAccess content files
 Usage:
   oa_source_bot.py [--conf-file=FILENAME] [--log-dir=DIRECTORY]
                    [--console-level=LEVEL] [--test]
+  oa_source_bot.py --backfill [--subreddits=NAMES] [--hours=HOURS]
+                   [--conf-file=FILENAME] [--log-dir=DIRECTORY]
+                   [--console-level=LEVEL]
+  oa_source_bot.py --replay=FILENAME [--speed=FACTOR]
+                   [--conf-file=FILENAME] [--log-dir=DIRECTORY]
+                   [--console-level=LEVEL]
   oa_source_bot.py [--help | --version]
 
 Options:
@@ -18,22 +24,52 @@ Options:
                             (one of: "CRITICAL", "ERROR", "WARNING", "INFO",
                             "DEBUG", "SILENT") [default: INFO]
   -t --test                 Launch the bot in test mode, only watches /r/test
+  -b --backfill             Reply to the posts missed in the recent history of
+                            the watched subreddits, then exit. An interrupted
+                            backfill is resumed
+  -s --subreddits=NAMES     Comma separated subreddits to backfill instead of
+                            all the watched subreddits
+  --hours=HOURS             How many hours back to backfill [default: 24]
+  -r --replay=FILENAME      Feed the submissions of a capture file through the
+                            filters and a dry run of replying, offline, then
+                            exit. Nothing is posted or converted
+  --speed=FACTOR            Replay at FACTOR times real time, or as fast as
+                            possible if 0 [default: 0]
   -h --help                 Print this help message and exit
   -v --version              Print the version and exit
 """
 #TODO: Think about other options that might be useful, perhaps a --test flag
 
-from bot_utils import timer
-from collections import deque
+from backfill import Backfill
+from capture import CaptureWriter, paced, read_capture
+from bot_utils import PeriodicScheduler, TTLCache
+from cluster import (Cluster, SharedIndexGenerator, SharedJobJournal,
+                     SharedOutputStore, SharedSeenStore, SharedState)
+from concurrent.futures import ThreadPoolExecutor
+from conversion import ConversionExecutor
 from docopt import docopt
 from domains import *
+from filters import FilterChain, FilterStage
+from indexer import IndexGenerator
+from job_journal import JobJournal
+import functools
 import json
 import logging
 import logging.handlers
+from log_records import JSONFormatter, start_listener
+from metrics import metrics, MetricsServer
 import os
+from output_store import OutputStore
+from pipeline import ReplyPipeline
 import praw
-import shutil
-import subprocess
+from rate_limit import (MAIL, MAINTENANCE, REPLY, RequestScheduler,
+                        ScheduledHandler, priority)
+from review import ReviewIndex
+from seen_store import SeenStore
+from source_cache import SourceCache
+from streams import MultiredditStream
+from wiki_lists import WikiList
+import socket
 import sys
 import time
 
@@ -41,45 +77,104 @@ __version__ = '0.0.3'
 LOGNAME = 'OA_source_bot'
 
 
-def logging_config(log_dir, console_level, smtp=None):
+def logging_config(log_dir, console_level, smtp=None, mode='plain',
+                   sample_rate=None):
+    """
+    In the 'plain' mode records are written by the thread logging them. In
+    the 'structured' mode they are written as JSON lines by a background
+    thread, and per-post debug events are sampled to `sample_rate` a second;
+    the QueueListener doing so is returned, to be stopped on exit.
+    """
     log = logging.getLogger(LOGNAME)
     log.setLevel(logging.DEBUG)
     if not os.path.isdir(log_dir):
         os.makedirs(log_dir)
     log_file = os.path.join(log_dir, LOGNAME)
+    handlers = []
     trfh = logging.handlers.TimedRotatingFileHandler(log_file,
                                                      when='midnight',
                                                      utc=True)
     trfh.setLevel(logging.DEBUG)
-    trfh.setFormatter(logging.Formatter('%(name)s [%(levelname)s] %(message)s'))
-    log.addHandler(trfh)
+    if mode == 'structured':
+        trfh.setFormatter(JSONFormatter())
+    else:
+        trfh.setFormatter(logging.Formatter('%(name)s [%(levelname)s] %(message)s'))
+    handlers.append(trfh)
     if console_level.upper() != 'SILENT':
         sh = logging.StreamHandler(sys.stdout)
         sh.setLevel(logging.INFO)
         sh.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
-        log.addHandler(sh)
+        handlers.append(sh)
+    if mode == 'structured':
+        return start_listener(log, handlers, sample_rate=sample_rate)
+    for handler in handlers:
+        log.addHandler(handler)
+    return None
 
 log = logging.getLogger(LOGNAME)
 
 
+class ReplayNatureDomain(NatureDomain):
+    """
+    NatureDomain that never fetches article pages, keeping replays offline.
+    Opt-in open access articles are counted as closed.
+    """
+    access_cache = TTLCache(ttl=6 * 3600, maxsize=5000)
+    unchecked = 0
+
+    @classmethod
+    def fetch_access(self, full_url):
+        self.unchecked += 1
+        return False
+
+
+def replay(config, path, speed=None):
+    """
+    Replay a capture with a bot that uses a stand-in reddit session, keeps
+    its state in a scratch directory, does not reply and makes no requests.
+    The watched subreddits and ignored users are copied into the scratch
+    directory from their local snapshots, and the replay refuses to start
+    without them.
+    """
+    from fakes import FakeReddit
+    import shutil
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix='oa_replay-') as scratch:
+        config = dict(config)
+        for key, default in (('ignored-users-file', 'ignored_users'),
+                             ('watched-subreddits-file', 'watched_subreddits')):
+            local_path = config.get(key, default)
+            copies = [p for p in (local_path, local_path + '.snapshot') if os.path.isfile(p)]
+            if not copies:
+                sys.exit('Cannot replay without {0} or {0}.snapshot, run the bot '
+                         'once to take a snapshot of the list'.format(local_path))
+            config[key] = os.path.join(scratch, os.path.basename(local_path))
+            shutil.copyfile(copies[0], config[key] + '.snapshot')
+        config.update({'seen-store-file': os.path.join(scratch, 'already_seen.journal'),
+                       'job-journal-file': os.path.join(scratch, 'reply_jobs.journal'),
+                       'review-index-file': os.path.join(scratch, 'review_index.json'),
+                       'public-dropbox-dir': os.path.join(scratch, 'dropbox'),
+                       'output-store-manifest': os.path.join(scratch, 'output_store.json'),
+                       'index-manifest': os.path.join(scratch, 'index_manifest.json'),
+                       'source-cache-dir': os.path.join(scratch, 'source_cache'),
+                       'capture-file': None,
+                       'worker-mode': False})
+        os.makedirs(config['public-dropbox-dir'])
+        bot = OASourceBot(config, reddit=FakeReddit(username=config['username']))
+        bot.oa_domains = DomainRegistry([PLoSDomain, ReplayNatureDomain])
+        bot.replay(path, speed=speed)
+        if ReplayNatureDomain.unchecked:
+            log.info('{0} opt-in Nature articles were counted as closed without checking'.format(ReplayNatureDomain.unchecked))
+
+
 class OASourceBot(object):
     user_agent = 'OA_source_bot v. {0} by /u/SavinaRoja, at /r/OA_source_bot'.format(__version__)
-    ignored_users = set()
-    watched_subreddits = set()
-    oa_domains = {'plosone.org': PLoSDomain,
-                  'plosbiology.org': PLoSDomain,
-                  'ploscompbiol.org': PLoSDomain,
-                  'ploscollections.org': PLoSDomain,
-                  'plosgenetics.org': PLoSDomain,
-                  'plospathogens.org': PLoSDomain,
-                  'plosntds.org': PLoSDomain,
-                  'plosmedicine.org': PLoSDomain,
-                  'nature.com': NatureDomain}
-    already_seen = deque(maxlen=2000)  # Am I being too conservative here?
+    oa_domains = registry  # Indexed by host suffix, see domains.py
     temp_message = 'Initiating reply, refresh in a few seconds.'
+    placeholder_grace = 900  # Seconds before a placeholder counts as abandoned
 
-    def __init__(self, config, test=None):
-        #TODO: Do some checking for locally written wikipage data dumps
+    def __init__(self, config, test=None, reddit=None):
+        self.started = time.monotonic()
         log.info('Starting OA_source_bot')
         #Load the JSON configuration file
         self.config = config
@@ -88,15 +183,59 @@ class OASourceBot(object):
         self.username = self.config['username']
         self.password = self.config['password']
 
-        self.subscribe = 'test' if test is not None else 'all'
-
-        self.reddit = praw.Reddit(self.user_agent)
+        self.subscribe = 'test' if test else 'all'
+
+        #Every API request waits on the scheduler's token bucket, by priority
+        self.api = RequestScheduler(rate=self.config.get('api-rate', 0.5),
+                                    burst=self.config.get('api-burst', 5))
+        #A stand-in session may be given, as the benchmarks do. The session is
+        #shared by all threads, see ScheduledHandler for why that is safe
+        if reddit is None:
+            reddit = praw.Reddit(self.user_agent,
+                                 handler=ScheduledHandler(self.api))
+        self.reddit = reddit
+
+        #In worker mode several processes share the seen store, job queue and
+        #maintenance lease through a SQLite database
+        self.cluster = None
+        if self.config.get('worker-mode'):
+            self.join_cluster()
+
+        #The network-bound steps run alongside each other and the local ones
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup') as startup:
+            session = startup.submit(self.start_session)
+            wikipages = startup.submit(self.parse_wikipages)
+            self.load_already_seen()
+            self.load_job_journal()
+            self.load_output_store()
+            self.source_cache = SourceCache(self.config.get('source-cache-dir', 'source_cache'),
+                                            quota=self.config.get('source-cache-quota'),
+                                            workers=self.config.get('source-prefetch-workers', 2),
+                                            timeout=self.config.get('source-fetch-timeout', 60))
+            session.result()
+            wikipages.result()
+        self.core_filters = self.build_core_filters()
+        self.pipeline = ReplyPipeline(self.reply_to_post,
+                                      workers=self.config.get('reply-workers', 2),
+                                      maxsize=self.config.get('reply-queue-size', 50))
+        self.moderator_cache = TTLCache(ttl=self.config.get('moderator-cache-ttl', 3600))
+        self.converter = ConversionExecutor(workers=self.config.get('conversion-workers'),
+                                            timeout=self.config.get('conversion-timeout', 300),
+                                            backend=self.config.get('conversion-backend', 'library'))
+        self.active = False
+        self.scheduler = None
+        self.first_post_seconds = None
+        self.conversion_estimate = None  # Moving average of conversion times
+        #Replays filter posts as usual but only pretend to reply
+        self.dry_run = False
+        capture_file = self.config.get('capture-file')
+        self.capture = CaptureWriter(capture_file) if capture_file else None
+        log.info('Initialised in {0:.2f}s'.format(time.monotonic() - self.started))
+
+    def start_session(self):
         self.login()
         self.myself = self.reddit.get_redditor(self.username)
-
-        self.load_already_seen()
-        self.parse_wikipages()
-        self.active = False
+        self.load_review_index()
 
     def login(self):
         login_attempt = True
@@ -114,22 +253,76 @@ class OASourceBot(object):
                 login_attempt = False
                 log.info('Login successful!')
 
+    def join_cluster(self):
+        #Each worker has its own working directory, which keeps the default
+        #ID stable across restarts, so the ring does not reshuffle on each
+        worker_id = self.config.get('worker-id') or '{0}:{1}'.format(socket.gethostname(), os.getcwd())
+        self.shared_state = SharedState(self.config.get('cluster-db', 'cluster.sqlite3'))
+        self.cluster = Cluster(self.shared_state, worker_id,
+                               lease_ttl=self.config.get('lease-ttl', 90))
+        #Heartbeats have their own thread, so a stall elsewhere, or a
+        #backfill that runs no scheduler, never gets this worker dropped
+        self.cluster.start(self.config.get('cluster-heartbeat', 30))
+        log.info('Running as worker {0}'.format(worker_id))
+
     def load_already_seen(self):
-        if os.path.isfile('already_seen'):
-            with open('already_seen') as inf:
-                for line in inf:
-                    self.already_seen.append(line.rstrip())
+        retention_hours = self.config.get('seen-retention-hours', 168)
+        if self.cluster is not None:
+            self.already_seen = SharedSeenStore(self.shared_state,
+                                                retention=retention_hours * 3600)
+            return
+        self.already_seen = SeenStore(self.config.get('seen-store-file', 'already_seen.journal'),
+                                      retention=retention_hours * 3600)
+
+    def load_job_journal(self):
+        max_age = self.config.get('job-max-age-hours', 24) * 3600
+        if self.cluster is not None:
+            self.jobs = SharedJobJournal(self.shared_state, self.cluster.worker_id,
+                                         max_age=max_age)
+            return
+        self.jobs = JobJournal(self.config.get('job-journal-file', 'reply_jobs.journal'),
+                               max_age=max_age)
+
+    def load_output_store(self):
+        dropbox_dir = self.config['public-dropbox-dir']
+        quota = self.config.get('public-dropbox-quota')
+        manifest = self.config.get('output-store-manifest', 'output_store.json')
+        batch_delay = self.config.get('index-batch-delay', 5)
+        if self.cluster is not None:
+            #Workers on a host publish to the same dropbox directory
+            self.output_store = SharedOutputStore(self.shared_state, dropbox_dir,
+                                                  quota=quota, manifest_path=manifest)
+            self.indexer = SharedIndexGenerator(self.shared_state, dropbox_dir,
+                                                batch_delay=batch_delay)
+            return
+        self.output_store = OutputStore(dropbox_dir, quota=quota, manifest_path=manifest)
+        self.indexer = IndexGenerator(dropbox_dir,
+                                      manifest_path=self.config.get('index-manifest', 'index_manifest.json'),
+                                      batch_delay=batch_delay)
+
+    def owns_subreddit(self, name):
+        """
+        In worker mode the watched subreddits are split between the workers;
+        otherwise they are all this process's.
+        """
+        return self.cluster is None or self.cluster.owns(name)
 
     def parse_wikipages(self):
         log.info('Attempting to load information from wikipages')
-        ignored_users = self.config['ignored-users-wikipage']
-        ignored_page = self.reddit.get_wiki_page(self.username, ignored_users)
-        for user in ignored_page.content_md.split('\n'):
-            self.ignored_users.add(user.strip())
-        watched_subs = self.config['watched-subreddits-wikipage']
-        watched_page = self.reddit.get_wiki_page(self.username, watched_subs)
-        for sub in watched_page.content_md.split('\n'):
-            self.watched_subreddits.add(sub.strip())
+        debounce = self.config.get('wiki-write-debounce', 60)
+        self.ignored_users = WikiList('ignored users', self.username,
+                                      self.config['ignored-users-wikipage'],
+                                      self.config.get('ignored-users-file', 'ignored_users'),
+                                      debounce=debounce)
+        self.watched_subreddits = WikiList('watched subreddits', self.username,
+                                           self.config['watched-subreddits-wikipage'],
+                                           self.config.get('watched-subreddits-file', 'watched_subreddits'),
+                                           debounce=debounce)
+        #Lists restored from their local snapshots are good enough to start
+        #streaming with; flush_wikipages reconciles them with the wikipages
+        for wiki_list in (self.ignored_users, self.watched_subreddits):
+            if not wiki_list.restore():
+                wiki_list.load(self.reddit)
 
     def core_predicate(self, post):
         """
@@ -137,23 +330,40 @@ class OASourceBot(object):
         This will return True only for posts to which OA_source_bot will
         try to reply to.
         """
-        if post.subreddit.display_name not in self.watched_subreddits:
-            return False
-        if post.author is None:  # Deleted? Removed? Skip it.
-            return False
-        if post.author.name in self.ignored_users:
-            return False
-        if post.id in self.already_seen:
-            return False
-        if post.domain not in self.oa_domains:
-            return False
-        return True
+        return self.core_filters(post)
+
+    def build_core_filters(self):
+        """
+        The stages of the core predicate. Costs are relative estimates; the
+        chain reorders itself from observed rejection rates.
+        """
+        def domain(post):
+            return post.domain in self.oa_domains
+
+        def seen(post):
+            return post.id not in self.already_seen
+
+        def subreddit(post):
+            return post.subreddit.display_name in self.watched_subreddits
+
+        def author(post):
+            #Reading the author may trigger a lazy load, so it costs the most
+            if post.author is None:  # Deleted? Removed? Skip it.
+                return False
+            return post.author.name not in self.ignored_users
+
+        return FilterChain([FilterStage('domain', domain, cost=1.0),
+                            FilterStage('seen', seen, cost=1.0),
+                            FilterStage('subreddit', subreddit, cost=2.0),
+                            FilterStage('author', author, cost=20.0)])
 
     def run(self):
         log.info('Initiating Run')
         self.active = True
-        self.review_posts()
-        self.check_mail()
+        self.pipeline.start()
+        self.resume_jobs()
+        self.start_metrics_server()
+        self.start_scheduler()
         while self.active:
             try:
                 log.info('Running')
@@ -166,41 +376,363 @@ class OASourceBot(object):
                     time.sleep(30)
                 except KeyboardInterrupt:
                     self.active = False
+        self.shutdown()
+
+    @priority(MAINTENANCE)
+    def backfill(self, subreddits=None, hours=24):
+        """
+        Reply to the posts of the last `hours` hours in `subreddits` (by
+        default all the watched subreddits) that were missed, then shut down.
+        Posts pass the usual filters, so subreddits must be watched, and up to
+        'backfill-concurrency' replies and their conversions run at once.
+        """
+        self.reconcile_wikipages()
+        if not subreddits:
+            subreddits = list(self.watched_subreddits)
+        concurrency = self.config.get('backfill-concurrency', 4)
+        self.pipeline = ReplyPipeline(self.reply_to_post, workers=concurrency,
+                                      maxsize=concurrency * 2)
+        self.pipeline.start()
+        self.resume_jobs()
+        backfill = Backfill(self.reddit, subreddits, time.time() - hours * 3600,
+                            lambda posts: self.process_posts(posts, sharded=False),
+                            self.config.get('backfill-checkpoint-file', 'backfill_checkpoint.json'))
+        log.info('Backfilling {0} subreddits'.format(len(backfill.subreddits)))
+        try:
+            backfill.run()
+        except KeyboardInterrupt:
+            log.info('Backfill interrupted, it will resume from its checkpoint')
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        log.info('Finishing queued replies before shutting down!')
+        self.pipeline.shutdown(drain=True)
+        self.converter.shutdown()
+        self.source_cache.shutdown()
+        self.indexer.flush()
+        self.jobs.compact()
+        self.review_index.save()
         log.info('Writing data before shutting down!')
-        self.write_all_data()
+        if self.cluster is None or self.cluster.is_leader():
+            self.write_all_data(immediate=True)
+        if self.cluster is not None:
+            self.cluster.leave()
+        if self.capture is not None:
+            self.capture.close()
         log.info('Shutting down!')
 
+    def start_scheduler(self):
+        """
+        Periodic jobs run on the scheduler's own thread, on their own timers,
+        whether or not the stream is delivering posts.
+        """
+        self.scheduler = PeriodicScheduler(observer=self.observe_job)
+        if self.cluster is not None:
+            self.scheduler.add('adopt_jobs', self.leader_only(self.adopt_jobs),
+                               self.config.get('cluster-heartbeat', 30), jitter=2)
+            self.scheduler.add('refresh_wikipages', self.refresh_wikipages,
+                               self.config.get('wiki-refresh-interval', 300), jitter=15)
+        #Restored wikipage lists are reconciled by the first flush, at once
+        self.scheduler.add('flush_wikipages', self.flush_wikipages, 30, delay=0)
+        #Review and mail run once straight away, as they did at startup
+        self.scheduler.add('review_posts', self.leader_only(self.review_posts),
+                           300, jitter=15, delay=0)
+        self.scheduler.add('check_mail', self.leader_only(self.check_mail),
+                           300, jitter=15, delay=0)
+        self.scheduler.add('backup_data', self.leader_only(self.backup_data),
+                           1800, jitter=60)
+        self.scheduler.add('metrics_summary', metrics.report,
+                           self.config.get('metrics-summary-interval', 900))
+        self.scheduler.start()
+
+    def leader_only(self, func):
+        """
+        Wrap a periodic job so that in worker mode only the holder of the
+        maintenance lease runs it.
+        """
+        @functools.wraps(func)
+        def job():
+            if self.cluster is None or self.cluster.is_leader():
+                return func()
+        return job
+
+    @priority(MAINTENANCE)
+    def adopt_jobs(self):
+        """
+        Adopt and resume the unfinished jobs of workers that have gone.
+        """
+        adopted = self.jobs.adopt(self.cluster.lease_ttl)
+        if adopted:
+            log.info('Adopted {0} reply jobs from stopped workers'.format(len(adopted)))
+            self.resume_jobs(adopted)
+
+    def observe_job(self, job, seconds):
+        metrics.observe('job_seconds', seconds, job=job.name)
+
+    def start_metrics_server(self):
+        port = self.config.get('metrics-port')
+        if port is None:
+            return
+        try:
+            self.metrics_server = MetricsServer(metrics, port)
+        except OSError as e:
+            log.exception(e)
+            log.error('Unable to serve metrics on port {0}'.format(port))
+            return
+        self.metrics_server.start()
+
+    def submission_source(self):
+        """
+        Returns an iterable of new submissions. With the 'multireddit' stream
+        mode only the watched subreddits are polled, in URL-length-safe groups,
+        with a periodic sweep of /r/all to catch posts the multireddit
+        listings were late to show. Otherwise all of /r/all (or /r/test in
+        test mode) is streamed and left to core_predicate filtering.
+        """
+        if self.subscribe == 'all' and self.config.get('stream-mode') == 'multireddit':
+            return MultiredditStream(self.reddit,
+                                     lambda: [name for name in self.watched_subreddits
+                                              if self.owns_subreddit(name)],
+                                     poll_interval=self.config.get('multireddit-poll-interval', 30),
+                                     sweep_interval=self.config.get('all-sweep-interval', 600))
+        return praw.helpers.submission_stream(self.reddit,
+                                              self.subscribe,
+                                              limit=None,
+                                              verbosity=0)
+
+    @priority(REPLY)
     def _run(self):
-        #A multireddit could be employed as shown in the commented line below,
-        #however comment lags (as is common when just developing on /r/test)
-        #sometimes require the use of 'all' and core_predicate filtering
-        #If you want to run a test, switch the 'all' to 'test' and make your
-        #test posts in /r/test
-        for post in praw.helpers.submission_stream(self.reddit,
-                                                   self.subscribe,
-                                                   #'+'.join(self.watched_subreddits),
-                                                   limit=None,
-                                                   verbosity=0):
-
-            #The intervals for these is implemented by their timers
-            self.review_posts()
-            self.check_mail()
-            self.backup_data()
+        for post in self.submission_source():
+            if self.first_post_seconds is None:
+                self.first_post_seconds = time.monotonic() - self.started
+                metrics.set('time_to_first_post_seconds', self.first_post_seconds)
+                log.info('First post received {0:.2f}s after starting'.format(self.first_post_seconds))
+            metrics.inc('posts_seen_total')
+            metrics.observe('stream_lag_seconds', max(0.0, time.time() - post.created_utc))
+            if self.capture is not None:
+                self.capture.record(post)
+            self.process_post(post)
+
+    def replay(self, path, speed=None):
+        """
+        Feed the submissions of a capture file through the filters and domain
+        predicates, at `speed` times real time or as fast as possible, with
+        a dry run in place of replying.
+        """
+        self.dry_run = True
+        log.info('Replaying {0}'.format(path))
+        start = time.monotonic()
+        count = 0
+        accepted = 0
+        for post in paced(read_capture(path), speed):
+            count += 1
+            metrics.inc('posts_seen_total')
+            if self.process_post(post, sharded=False):
+                accepted += 1
+        seconds = time.monotonic() - start
+        log.info('Replayed {0} posts in {1:.2f}s ({2:.0f} posts/s), {3} would have been replied to'.format(count, seconds, count / seconds if seconds else 0.0, accepted))
+        self.core_filters.report()
+        self.converter.shutdown()
+        self.source_cache.shutdown()
+
+    def process_post(self, post, sharded=True):
+        """
+        Filter a post and, if it is accepted, queue a reply to it. Returns
+        True if a reply was queued. Unless `sharded` is False, in worker mode
+        only posts in this worker's subreddits are accepted.
+        """
+        if not self.accept_post(post, sharded):
+            return False
+        #Classify the post's URL, then apply the domain-specific predicate
+        return self.queue_match(self.oa_domains.classify(post))
 
-            #Apply the core predicate to the post
-            if not self.core_predicate(post):
-                continue
-            #Apply the domain-specific predicate to the post
-            if not self.oa_domains[post.domain].predicate(post):
-                continue
+    def process_posts(self, posts, sharded=True):
+        """
+        Like process_post for a batch of posts, such as a listing page, whose
+        URLs are classified together. Returns the number of replies queued.
+        """
+        accepted = [post for post in posts if self.accept_post(post, sharded)]
+        matches = self.oa_domains.classify_batch(accepted)
+        return sum(1 for match in matches if self.queue_match(match))
 
-            #Add the post id to the record of already seen, then reply
-            self.already_seen.append(post.id)
-            self.reply_to_post(post)
+    def accept_post(self, post, sharded=True):
+        """
+        Apply the core predicate to a post, and in worker mode unless
+        `sharded` is False, check that it is in this worker's subreddits.
+        """
+        with metrics.timer('stage_seconds', stage='core_predicate'):
+            accepted = self.core_predicate(post)
+        if not accepted:
+            return False
+        return not sharded or self.owns_subreddit(post.subreddit.display_name)
+
+    def queue_match(self, match):
+        """
+        Apply the domain-specific predicate to a classified post and, if it
+        is accepted, queue a reply to it. Returns True if a reply was queued.
+        """
+        if match is None:
+            return False
+        post = match.post
+        with metrics.timer('stage_seconds', stage='domain_predicate',
+                           domain=match.domain.__name__):
+            accepted = match.domain.predicate(match)
+        if not accepted:
+            return False
+        metrics.inc('posts_accepted_total', domain=match.domain.__name__)
+
+        #Add the post id to the record of already seen, then queue the
+        #reply for the workers so the stream is not held up. In worker
+        #mode another process may have claimed the post first
+        if not self.already_seen.add(post.id):
+            return False
+        if self.dry_run:
+            self.dry_run_reply(match)
+            return True
+        self.jobs.start(post.id)
+        self.prefetch_source(match)
+        self.pipeline.submit(match)
+        return True
+
+    def dry_run_reply(self, match):
+        """
+        Compose the reply to a post, without its EPUBs, and log it in place of
+        posting it.
+        """
+        domain_obj = match.domain
+        self.reply_text(match, '')
+        if domain_obj.oaepub_support:
+            domain_obj.doi(match)
+        log.info('Dry run reply to post {0}'.format(match.post.id),
+                 extra={'event': 'reply', 'post': match.post.id})
+        metrics.inc('replies_total', domain=domain_obj.__name__)
+
+    def prefetch_source(self, match):
+        """
+        Start downloading the article's source XML, unless its EPUBs are
+        already published, so that it arrives while the reply is under way.
+        """
+        domain_obj = match.domain
+        if not domain_obj.oaepub_support:
+            return
+        url = domain_obj.source_url(match)
+        article_doi = domain_obj.doi(match)
+        if url is None or all(self.output_store.has(article_doi, v) for v in (2, 3)):
+            return
+        self.source_cache.prefetch(article_doi, url)
+
+    @priority(REPLY)
+    def resume_jobs(self, pending=None):
+        """
+        Queue the reply jobs left unfinished by a previous run, or the given
+        post IDs; each carries on from the last step its journal records.
+        """
+        if pending is None:
+            pending = self.jobs.unfinished()
+        if not pending:
+            return
+        log.info('Resuming {0} unfinished reply jobs'.format(len(pending)))
+        resumed = set()
+        batch_size = 100
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            posts = self.reddit.get_info(thing_id=['t3_' + i for i in batch])
+            for match in self.oa_domains.classify_batch(posts or []):
+                if match is not None:
+                    post = match.post
+                    resumed.add(post.id)
+                    self.pipeline.submit(match)
+        for post_id in set(pending).difference(resumed):
+            log.info('Abandoning reply job for post {0}, could not retrieve it'.format(post_id))
+            self.jobs.abandon(post_id)
+
+    @priority(REPLY)
+    def reply_to_post(self, match):
+        """
+        Reply to a post with links to the article, and to its EPUBs where the
+        domain supports them. How the reply is written depends on 'reply-mode':
+
+        * 'single' posts the complete reply once, when the EPUBs are ready
+        * 'edit' posts a placeholder at once and edits it when complete
+        * 'adaptive' (the default) posts once if the EPUBs are published
+          already or conversions are quick enough, and otherwise posts the
+          links at once and adds the EPUBs with a single edit
+
+        A job resumed after a restart carries on with the comment it posted.
+        """
+        post = match.post
+        domain_obj = match.domain
+        if not self.owns_job(post):
+            return
+        job = self.jobs.get(post.id) or {}
+        mode = self.config.get('reply-mode', 'adaptive')
+        reply = None
+        posted = None  # The text of the reply as it stands, if known
+        if job.get('comment_id') is not None:
+            #Resumed after a restart, carry on with the comment posted
+            log.info('Resuming reply to post {0}'.format(post.id))
+            reply = self.reddit.get_info(thing_id='t1_' + job['comment_id'])
+            if reply is not None and reply.author is None:  # Deleted meanwhile
+                reply = None
+        if reply is None and mode == 'edit':
+            posted = self.temp_message
+            reply = self.post_reply(post, posted)
+
+        epub = ''
+        if domain_obj.oaepub_support:
+            article_doi = domain_obj.doi(match)
+            epubs = job.get('epubs')
+            if epubs is None:
+                if (reply is None and mode == 'adaptive' and
+                        not self.epubs_ready_soon(article_doi)):
+                    #Conversions are slow, so the EPUBs follow in one edit
+                    posted = self.reply_text(match, '')
+                    reply = self.post_reply(post, posted)
+                epubs = self.produce_epubs(domain_obj, article_doi,
+                                           domain_obj.source_url(match))
+                self.jobs.converted(post.id, epubs)
+            epub = self.epub_text(epubs)
+            #The job may have been adopted by another worker meanwhile
+            if not self.owns_job(post):
+                return
+
+        text = self.reply_text(match, epub)
+        if reply is None:
+            self.post_reply(post, text)
+        elif text != posted:
+            with metrics.timer('reddit_seconds', call='edit'):
+                reply.edit(text)
+        self.jobs.edited(post.id)
+        metrics.inc('replies_total', domain=domain_obj.__name__)
+
+    def owns_job(self, post):
+        """
+        False if the reply job for a post has been reassigned to another
+        worker, as happens if this one was dropped from the cluster.
+        """
+        if self.jobs.owns(post.id):
+            return True
+        log.warning('Reply job for post {0} was reassigned, leaving it'.format(post.id))
+        return False
 
-    def reply_to_post(self, post):
-        log.info('Replying to post {0}'.format(post.id))
-        reply = post.add_comment(self.temp_message)
+    def post_reply(self, post, text):
+        """
+        Comment on a post, recording the comment in the job journal and the
+        review index. Returns the comment.
+        """
+        log.info('Replying to post {0}'.format(post.id),
+                 extra={'event': 'reply', 'post': post.id})
+        with metrics.timer('reddit_seconds', call='add_comment'):
+            reply = post.add_comment(text)
+        self.jobs.placeholder(post.id, reply.id)
+        self.review_index.track(reply.id, post_id=post.id)
+        return reply
+
+    def reply_text(self, match, epub):
+        post = match.post
         text = '''\
 This article is freely available online to everyone as \
 **[OpenAccess](http://en.wikipedia.org/wiki/Open_access)**.
@@ -214,11 +746,22 @@ ___
 >Link to the article's **[PDF]({pdf})**{epub}
 
 ^[ ^Original ^poster, ^/u/{op}, ^can [^delete]\
-(http://www.reddit.com/message/compose?to=OA_source_bot&amp;subject=Delete&amp;message={comment-id})\
+(http://www.reddit.com/message/compose?to=OA_source_bot&amp;subject=Delete&amp;message={post-id})\
 ^. ^Will ^also ^delete ^on ^score ^less ^than ^0. ^| [^About ^Me]\
 (http://www.np.reddit.com/r/OA_source_bot/wiki/index) ^]
 '''
-
+        #The delete link names the post, as the comment's ID is not known
+        #until the comment has been posted
+        return text.format(**{'online': post.url,
+                              'op': post.author,
+                              'pdf': match.domain.pdf_url(match),
+                              'epub': epub,
+                              'post-id': post.fullname})
+
+    def epub_text(self, epubs):
+        """
+        Returns the reply section linking to the EPUBs produced, if any.
+        """
         epub_text = '''
 
 ___
@@ -231,198 +774,329 @@ ___
 development by /u/SavinaRoja; please contact if you spot any problems, have \
 feedback/suggestions, or would like to contribute.*
 '''
+        dropbox_url = self.config['dropbox-index-url']
+        epub2 = epubs[2] is not None
+        epub3 = epubs[3] is not None
+        epub2_url = dropbox_url + epubs[2] if epub2 else None
+        epub3_url = dropbox_url + epubs[3] if epub3 else None
 
-        domain_obj = self.oa_domains[post.domain]
-        pdf_url = domain_obj.pdf_url(post)
-
-        if not domain_obj.oaepub_support:
-            reply.edit(text.format(**{'online': post.url,
-                                      'op': post.author,
-                                      'pdf': pdf_url,
-                                      'epub': '',
-                                      'comment-id': reply.id}))
-            return
+        if not any([epub2, epub3]):  # Neither were successful, ignore EPUB
+            return ''
+        elif all([epub2, epub3]):  # Both successful
+            formats = '[EPUB2]({0}) | [EPUB3]({1})'.format(epub2_url, epub3_url)
+            return epub_text.format(formats)
+        elif epub2:
+            return epub_text.format('[EPUB2]({0})'.format(epub2_url))
+        else:
+            return epub_text.format('[EPUB3]({0})'.format(epub3_url))
 
-        article_doi = domain_obj.doi(post)
+    def epubs_ready_soon(self, article_doi):
+        """
+        True if the article's EPUBs are published already, or conversions
+        have lately taken no longer than 'single-write-max-wait' seconds.
+        """
+        if all(self.output_store.has(article_doi, v) for v in (2, 3)):
+            return True
+        estimate = self.conversion_estimate
+        return (estimate is not None and
+                estimate <= self.config.get('single-write-max-wait', 15))
 
+    def produce_epubs(self, domain_obj, article_doi, source_url=None):
+        """
+        Returns a dict mapping EPUB version to the file's path relative to the
+        public dropbox dir, or None where it could not be produced. Files
+        already in the output store are reused without conversion. The
+        article's source is taken from the source cache, fetched from
+        `source_url` if not already there or on its way.
+        """
         dropbox_dir = self.config['public-dropbox-dir']
-        dropbox_url = self.config['dropbox-index-url']
-        #Torrents are on the backburner for now. Connectivity issues are being a
-        #massive pain... Bandwidth issue aside, I will eventually hit a storage
-        #cap, so getting this worked out is crucial.
         basename = domain_obj.file_basename_from_doi(article_doi)
-        epubname = basename + '.epub'
-        epub2name = os.path.join('epub2', '{0}-2.epub'.format(basename))
-        epub3name = os.path.join('epub3', '{0}-3.epub'.format(basename))
-        try:
-            epub2 = subprocess.check_call(['oaepub', 'convert',
-                                           '-2',
-                                           'doi:' + article_doi])
-        except subprocess.CalledProcessError as e:
-            log.exception(e)
-            log.error('Unable to produce EPUB for doi:{0}'.format(post))
-            epub2 = False
-        else:
-            epub2 = True
-            shutil.move(epubname, os.path.join(dropbox_dir, epub2name))
-            epub2_url = dropbox_url + epub2name
-
-        try:
-            epub3 = subprocess.check_call(['oaepub', 'convert',
-                                           '-3',
-                                           'doi:' + article_doi])
-        except subprocess.CalledProcessError as e:
-            log.exception(e)
-            epub3 = False
+        epubs = {}
+        needed = {}
+        for version in (2, 3):
+            epubs[version] = self.output_store.lookup(article_doi, version)
+            if epubs[version] is None:
+                name = os.path.join('epub{0}'.format(version),
+                                    '{0}-{1}.epub'.format(basename, version))
+                needed[version] = name
+        if not needed:
+            return epubs
+
+        #Missing versions are converted concurrently, each in its own scratch
+        #dir, from one copy of the source; without it oaepub fetches its own
+        start = time.monotonic()
+        source = self.source_cache.get(article_doi, source_url)
+        results = self.converter.convert(article_doi,
+                                         {v: os.path.join(dropbox_dir, name)
+                                          for v, name in needed.items()},
+                                         source=source)
+        self.observe_conversion(time.monotonic() - start)
+        for version, name in needed.items():
+            if results[version] is not None:
+                epubs[version] = name
+                evicted = self.output_store.add(article_doi, version, name)
+                #Only the changed listings are rewritten, batched with others
+                self.indexer.add(name)
+                for path in evicted:
+                    self.indexer.remove(path)
+        return epubs
+
+    def observe_conversion(self, seconds, weight=0.3):
+        """
+        Fold the time taken to produce an article's EPUBs, source download
+        included, into the moving average that decides how replies are made.
+        """
+        #Concurrent updates may lose one another, which an average can bear
+        estimate = self.conversion_estimate
+        if estimate is None:
+            estimate = seconds
         else:
-            epub3 = True
-            shutil.move(epubname, os.path.join(dropbox_dir, epub3name))
-            epub3_url = dropbox_url + epub3name
-
-        log.info('Calling pyndexer')
-        subprocess.call(['python', './patched_pyndexer/pyndexer.py'])
+            estimate += weight * (seconds - estimate)
+        self.conversion_estimate = estimate
+        metrics.set('conversion_estimate_seconds', estimate)
 
-        if not any([epub2, epub3]):  # Neither were successful, ignore EPUB
-            reply.edit(text.format(**{'online': post.url,
-                                      'op': post.author,
-                                      'pdf': pdf_url,
-                                      'epub': '',
-                                      'comment-id': reply.id}))
-            return
-        elif all([epub2, epub3]):  # Both successful
-            formats = '[EPUB2]({0}) | [EPUB3]({1})'.format(epub2_url, epub3_url)
-            epub_text = epub_text.format(formats)
-        elif epub2:
-            epub_text = epub_text.format('[EPUB2]({0})'.format(epub2_url))
-        elif epub3:
-            epub_text = epub_text.format('[EPUB2]({0})'.format(epub3_url))
-        reply.edit(text.format(**{'online': post.url,
-                                  'op': post.author,
-                                  'pdf': pdf_url,
-                                  'epub': epub_text,
-                                  'comment-id': reply.id}))
-
-    @timer(300)  # 5 minute interval
+    @priority(MAINTENANCE)
     def review_posts(self):
+        """
+        Re-check those of the bot's comments that are due according to the
+        review index, fetched in batched info requests. A cycle makes at most
+        'review-batches' requests however many comments the bot has made.
+        """
         log.debug('Reviewing posts')
-        user = self.myself
-        for comment in user.get_comments('all', limit=None):
-            if comment.score < 0:
-                comment.delete()
-                log.info('Deleting comment {0} for having a low score'.format(comment.id))
-                continue
-            elif comment.body == self.temp_message:
-                comment.delete()
-                log.info('Deleting comment {0} for being incomplete'.format(comment.id))
-                continue
-
-    @timer(300)  # 5 minute interval
+        batch_size = 100  # The most things a single info request will return
+        if self.cluster is not None:
+            #Comments made by other workers reach the index from the history
+            for comment in self.myself.get_comments(limit=batch_size):
+                if comment.id not in self.review_index:
+                    self.review_index.track(comment.id, comment.created_utc,
+                                            comment.link_id[3:])
+        due = self.review_index.due(batch_size * self.config.get('review-batches', 1))
+        for start in range(0, len(due), batch_size):
+            batch = due[start:start + batch_size]
+            checked = []
+            comments = self.reddit.get_info(thing_id=['t1_' + i for i in batch])
+            for comment in comments or []:  # None if every ID was invalid
+                if comment.author is None:  # Already deleted
+                    self.review_index.forget(comment.id)
+                elif comment.score < 0:
+                    comment.delete()
+                    self.review_index.forget(comment.id)
+                    log.info('Deleting comment {0} for having a low score'.format(comment.id),
+                             extra={'event': 'delete', 'comment': comment.id})
+                elif (comment.body == self.temp_message and
+                      self.review_index.age(comment.id) > self.placeholder_grace and
+                      not self.jobs.has_placeholder(comment.id)):
+                    comment.delete()
+                    self.review_index.forget(comment.id)
+                    log.info('Deleting comment {0} for being incomplete'.format(comment.id),
+                             extra={'event': 'delete', 'comment': comment.id})
+                else:
+                    checked.append(comment.id)
+            for comment_id in set(batch).difference(checked):
+                self.review_index.forget(comment_id)
+            self.review_index.checked(checked)
+        #Comments tracked since the last cycle are persisted once here
+        self.review_index.save()
+
+    def load_review_index(self):
+        self.review_index = ReviewIndex(self.config.get('review-index-file', 'review_index.json'),
+                                        cutoff=self.config.get('review-cutoff-days', 7) * 86400)
+        if not self.review_index.loaded:
+            #First run with an index; seed it from recent history just once
+            log.info('Seeding the review index from recent comments')
+            for comment in self.myself.get_comments('all', limit=1000):
+                self.review_index.track(comment.id, comment.created_utc,
+                                        comment.link_id[3:])
+            self.review_index.save()
+
+    @priority(MAIL)
     def check_mail(self):
         """
         Here is a proposed map of mail triggers and actions
-        message body "delete <comment-id>"
+        message body "delete <comment-id>" or "delete t3_<post-id>"
         """
-        #These are a map of message.subject to action
+        #These are a map of message.subject to action. Messages are handled in
+        #the order they arrived, except that remote kill comes last
         action_map = {'delete': self.delete_mail_request,
                       'ignore': self.ignore_user_request,
                       'unignore': self.unignore_user_request,
                       'watch subreddit': self.watch_subreddit_request,
                       'drop subreddit': self.drop_subreddit_request,
-                      'remote kill': self.remote_kill_request,
-                      'check submission': self.check_submission_request}
+                      'check submission': self.check_submission_request,
+                      'remote kill': self.remote_kill_request}
         log.debug('Checking mail')
-        for message in self.reddit.get_unread(limit=None):
-            action = action_map.get(message.subject.lower())
-            if action is None:
-                log.info('Unrecognized subject: {0}'.format(action.subject))
+        messages = list(self.reddit.get_unread(limit=None))
+        if not messages:
+            return
+        messages.sort(key=lambda message: message.created_utc)
+        #Only a sender's latest request for each target is acted on, so a
+        #request followed by its opposite ends as the sender last asked
+        latest = {}
+        requests = []
+        for message in messages:
+            subject = message.subject.lower()
+            if subject not in action_map:
+                log.info('Unrecognized subject: {0}'.format(message.subject))
+            elif message.author is None:
+                log.info('Ignoring {0} message without an author'.format(subject))
             else:
-                action(message)
+                key = self.mail_request_key(subject, message)
+                if key in latest:
+                    log.info('Skipping superseded {0} request from /u/{1}'.format(latest[key][0], key[0]))
+                latest[key] = (subject, message)
+                requests.append((key, subject, message))
+        requests = [(subject, message) for key, subject, message in requests
+                    if latest[key][1] is message]
+        requests.sort(key=lambda request: request[0] == 'remote kill')
+
+        #List changes are debounced by WikiList, so a burst of requests costs
+        #a single wikipage write per list
+        try:
+            for subject, message in requests:
+                action_map[subject](message)
+        finally:
+            self.mark_messages_read(messages)
+
+    @staticmethod
+    def mail_request_key(subject, message):
+        """
+        The sender and target of a mail request. Requests adding to and
+        removing from a list share a target, so the later one supersedes the
+        earlier.
+        """
+        sender = message.author.name
+        if subject in ('ignore', 'unignore'):
+            return sender, 'ignored users', sender
+        if subject in ('watch subreddit', 'drop subreddit'):
+            return sender, 'watched subreddits', message.body.strip().lower()
+        return sender, subject, message.body.strip().lower()
+
+    def mark_messages_read(self, messages):
+        batch_size = 100
+        for start in range(0, len(messages), batch_size):
+            try:
+                self.myself.mark_as_read(messages[start:start + batch_size])
+            except Exception as e:
+                log.exception(e)
+                log.error('Unable to mark messages as read')
+
+    def get_moderators(self, subname):
+        """
+        Returns the set of lowercased moderator names of a subreddit, cached
+        for 'moderator-cache-ttl' seconds.
+        """
+        key = subname.lower()
+        moderators = self.moderator_cache.get(key)
+        if moderators is None:
+            subreddit = self.reddit.get_subreddit(subname)
+            moderators = set(mod.name.lower() for mod in subreddit.get_moderators())
+            self.moderator_cache.set(key, moderators)
+        return moderators
+
+    def is_moderator(self, sender, subname):
+        if sender.name in self.config['bot-moderators']:
+            return True
+        return sender.name.lower() in self.get_moderators(subname)
 
     def delete_mail_request(self, message):
         sender = message.author.name
-        comment_id = message.body
+        comment_id = message.body.strip()
         log.info('/u/{0} requested deletion of comment {1}'.format(sender,
                                                                    comment_id))
-        self.myself.mark_as_read(message)
-        comment = self.reddit.get_info(thing_id='t1_{0}'.format(comment_id))
+        if comment_id.startswith('t3_'):
+            #Replies name their post, the bot's comment on it is the one meant
+            comment = self.find_reply(comment_id[3:])
+        else:
+            comment = self.reddit.get_info(thing_id='t1_{0}'.format(comment_id))
         if not comment:
             log.info('Invalid. Could not retrieve comment')
             return
+        comment_id = comment.id
         if sender == comment.submission.author.name:
-            log.info('Valid request from OP, deleting {0}'.format(comment_id))
+            log.info('Valid request from OP, deleting {0}'.format(comment_id),
+                     extra={'event': 'delete', 'comment': comment_id})
             comment.delete()
         elif sender == self.config['bot-moderators']:
-            log.info('Valid request from /u/{0}, deleting {1}'.format(sender, comment_id))
+            log.info('Valid request from /u/{0}, deleting {1}'.format(sender, comment_id),
+                     extra={'event': 'delete', 'comment': comment_id})
             comment.delete()
         else:
             log.info('Invalid. Not OP or mod')
 
+    def find_reply(self, post_id):
+        """
+        Returns the bot's comment on a post, or None. The comment is looked
+        up in the job journal and the review index; only for replies older
+        than the review cutoff are the post's top comments searched.
+        """
+        job = self.jobs.get(post_id)
+        comment_id = job.get('comment_id') if job is not None else None
+        if comment_id is None:
+            comment_id = self.review_index.comment_for(post_id)
+        if comment_id is not None:
+            return self.reddit.get_info(thing_id='t1_' + comment_id)
+        post = self.reddit.get_info(thing_id='t3_' + post_id)
+        if post is None:
+            return None
+        for comment in post.comments:
+            author = getattr(comment, 'author', None)  # None for MoreComments
+            if author is not None and author.name == self.config['username']:
+                return comment
+        return None
+
     def ignore_user_request(self, message):
         sender = message.author.name
         log.info('/u/{0} requested ignore, adding them to ignored users set'.format(sender))
-        self.myself.mark_as_read(message)
         self.ignored_users.add(sender)
-        self.write_ignored_users_to_wikipage()
 
     def unignore_user_request(self, message):
         sender = message.author.name
         log.info('/u/{0} requested unignore, removing them from ignored users set'.format(sender))
-        self.myself.mark_as_read(message)
         try:
             self.ignored_users.remove(sender)
         except KeyError:
             log.info('Invalid. /u/{0} was not in the ignored users set'.format(sender))
         else:
             log.info('Valid request. /u/{0} was successfully removed from unignored set'.format(sender))
-            self.write_ignored_users_to_wikipage()
 
     def watch_subreddit_request(self, message):
         sender = message.author
-        subname = message.body
-        subreddit = self.reddit.get_subreddit(subname)
+        subname = message.body.strip()
         log.info('/u/{0} requested addition of /r/{1} to watched subreddits set'.format(sender.name, subname))
-        self.myself.mark_as_read(message)
         try:
-            moderators = list(subreddit.get_moderators())
+            valid = self.is_moderator(sender, subname)
         except Exception as e:
             log.exception(e)
             log.info('Invalid request, probably does not exist')
+            return
+        if valid:
+            log.info('Valid request, adding /r/{0} to watched subreddit set'.format(subname))
+            self.watched_subreddits.add(subname)
         else:
-            if sender in moderators or sender.name in self.config['bot-moderators']:
-                log.info('Valid request, adding /r/{0} to watched subreddit set'.format(subname))
-                self.watched_subreddits.add(subname)
-                self.write_watched_subreddits_to_wikipage()
-
-            else:
-                log.info('Invalid. Not a mod of /r/{0}'.format(subname))
+            log.info('Invalid. Not a mod of /r/{0}'.format(subname))
 
     def drop_subreddit_request(self, message):
         sender = message.author
-        subname = message.body
-        subreddit = self.reddit.get_subreddit(subname)
+        subname = message.body.strip()
         log.info('/u/{0} requested dropping /r/{1} from watched subreddits set'.format(sender.name, subname))
-        self.myself.mark_as_read(message)
         try:
-            moderators = list(subreddit.get_moderators())
+            valid = self.is_moderator(sender, subname)
         except Exception as e:
             log.exception(e)
             log.info('Invalid request, probably does not exist')
-        else:
-            if sender in moderators or sender.name in self.config['bot-moderators']:
-                try:
-                    self.watched_subreddits.remove(subname)
-                except KeyError:
-                    log.info('Invalid. /r/{0} was not in watched_subreddits'.format(subname))
-                else:
-                    log.info('Valid request, removed /r/{0} from watched_subreddit set'.format(subname))
-                    self.write_watched_subreddits_to_wikipage()
-
+            return
+        if valid:
+            try:
+                self.watched_subreddits.remove(subname)
+            except KeyError:
+                log.info('Invalid. /r/{0} was not in watched_subreddits'.format(subname))
             else:
-                log.info('Invalid. Not a mod of /r/{0}'.format(subname))
+                log.info('Valid request, removed /r/{0} from watched_subreddit set'.format(subname))
+        else:
+            log.info('Invalid. Not a mod of /r/{0}'.format(subname))
 
     def remote_kill_request(self, message):
         sender = message.author.name
-        self.myself.mark_as_read(message)
         log.info('Received remove kill request from /u/{0}'.format(sender))
         if sender in self.config['bot-moderators']:
             log.info('Valid remote kill request by mod')
@@ -435,17 +1109,20 @@ feedback/suggestions, or would like to contribute.*
             #Apply the core predicate to the post
             if not self.core_predicate(post):
                 return
-            #Apply the domain-specific predicate to the post
-            if not self.oa_domains[post.domain].predicate(post):
+            #Classify the post's URL, then apply the domain-specific predicate
+            match = self.oa_domains.classify(post)
+            if match is None or not match.domain.predicate(match):
                 return
 
             #Add the post id to the record of already seen, then reply
-            self.already_seen.append(post.id)
-            self.reply_to_post(post)
+            if not self.already_seen.add(post.id):
+                return
+            self.jobs.start(post.id)
+            self.prefetch_source(match)
+            self.pipeline.submit(match)
 
         sender = message.author.name
         submission_id = message.body
-        self.myself.mark_as_read(message)
         log.info('Request to check submission {0} by /u/{1}'.format(submission_id, sender))
         submission = self.reddit.get_info(thing_id='t3_{0}'.format(submission_id))
         if not submission:
@@ -457,48 +1134,65 @@ feedback/suggestions, or would like to contribute.*
             log.info('Valid request, checking the submission')
             submission_check(submission)
 
-    @timer(1800)  # 30 minute interval
+    @priority(MAINTENANCE)
     def backup_data(self):
         log.info('Writing data')
         self.write_all_data()
+        self.output_store.report()
+        self.source_cache.report()
+        self.core_filters.report()
+        self.scheduler.report()
+        self.api.report()
 
     def write_already_seen_local(self):
-        log.info('Writing the record of posts that have already been seen to local file.')
-        with open('already_seen', 'w') as out:
-            for item in self.already_seen:
-                out.write(item + '\n')
-
-    def write_ignored_users_to_wikipage(self):
-        log.info('Writing the list of ignored users to the wikipage')
-        ignored_md = '\n'.join(['    ' + item for item in self.ignored_users])
-        try:
-            ign = self.reddit.get_wiki_page(self.username,
-                                            self.config['ignored-users-wikipage'])
-            ign.edit(ignored_md)
-        except Exception as e:
-            log.exception(e)
-            log.info('An error occurred while writing wikipage! Writing to file instead.')
-            with open('ignored_users', 'w') as out:
-                out.write(ignored_md)
-
-    def write_watched_subreddits_to_wikipage(self):
-        log.info('Writing the list of watched_subreddits to the wikipage')
-        watched_md = '\n'.join(['    ' + item for item in self.watched_subreddits])
-        try:
-            wat = self.reddit.get_wiki_page(self.username,
-                                            self.config['watched-subreddits-wikipage'])
-            wat.edit(watched_md)
-        except Exception as e:
-            log.exception(e)
-            log.info('An error occurred while writing wikipage! Writing to file instead.')
-            with open('watched_subreddits', 'w') as out:
-                out.write(watched_md)
+        #Additions are journaled as they happen, so this only compacts
+        log.info('Compacting the record of posts that have already been seen.')
+        self.already_seen.compact()
+
+    @priority(MAIL)
+    def reconcile_wikipages(self):
+        for wiki_list in (self.ignored_users, self.watched_subreddits):
+            if wiki_list.reconciled:
+                continue
+            try:
+                wiki_list.load(self.reddit)
+            except Exception as e:
+                log.exception(e)
+                log.info('Unable to reconcile {0} with the wikipage, will retry'.format(wiki_list.name))
 
-    def write_all_data(self):
-        self.write_already_seen_local()
+    @priority(MAINTENANCE)
+    def flush_wikipages(self):
+        self.reconcile_wikipages()
+        #Changes are only published once the debounce window has passed
         self.write_ignored_users_to_wikipage()
         self.write_watched_subreddits_to_wikipage()
 
+    @priority(MAINTENANCE)
+    def refresh_wikipages(self):
+        """
+        In worker mode only the leader changes the lists, as it handles the
+        mail; the other workers pick up its changes from the wikipages.
+        """
+        if self.cluster.is_leader():
+            return
+        for wiki_list in (self.ignored_users, self.watched_subreddits):
+            if wiki_list.dirty:
+                continue
+            try:
+                wiki_list.load(self.reddit)
+            except Exception as e:
+                log.exception(e)
+
+    def write_ignored_users_to_wikipage(self, immediate=False):
+        self.ignored_users.flush(self.reddit, immediate=immediate)
+
+    def write_watched_subreddits_to_wikipage(self, immediate=False):
+        self.watched_subreddits.flush(self.reddit, immediate=immediate)
+
+    def write_all_data(self, immediate=False):
+        self.write_already_seen_local()
+        self.write_ignored_users_to_wikipage(immediate=immediate)
+        self.write_watched_subreddits_to_wikipage(immediate=immediate)
 
 if __name__ == '__main__':
     args = docopt(__doc__, version=__version__)
@@ -508,7 +1202,20 @@ if __name__ == '__main__':
 
     log_dir = args['--log-dir'] if args['--log-dir'] else config['log-dir']
 
-    logging_config(log_dir, args['--console-level'])
-
-    bot = OASourceBot(config, test=args['--test'])
-    bot.run()
+    listener = logging_config(log_dir, args['--console-level'],
+                              mode=config.get('log-mode', 'plain'),
+                              sample_rate=config.get('log-sample-rate', 1.0))
+
+    try:
+        if args['--replay']:
+            replay(config, args['--replay'], speed=float(args['--speed']))
+        elif args['--backfill']:
+            bot = OASourceBot(config, test=args['--test'])
+            subreddits = args['--subreddits'].split(',') if args['--subreddits'] else None
+            bot.backfill(subreddits, hours=float(args['--hours']))
+        else:
+            bot = OASourceBot(config, test=args['--test'])
+            bot.run()
+    finally:
+        if listener is not None:
+            listener.stop()  # Writes out the records still queued
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the OutputStore, which keeps track of the EPUB files
+published in the public dropbox directory.
+
+Files are keyed by DOI and EPUB version, so an article that has already been
+converted for an earlier post is served again without another conversion. The
+store records the size and last-served time of every file and evicts the
+least recently served ones to stay under a byte quota.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+__all__ = ['OutputStore']
+
+log = logging.getLogger('OA_source_bot.output_store')
+
+
+class OutputStore(object):
+    """
+    A manifest of published files under `root`, persisted as JSON in
+    `manifest_path`. Paths are stored relative to `root`. The manifest is
+    kept out of `root`, which is public.
+    """
+    def __init__(self, root, quota=None, manifest_path='output_store.json'):
+        self.root = root
+        self.quota = quota
+        self.manifest_path = manifest_path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def key(doi, version):
+        return '{0}|{1}'.format(doi, version)
+
+    @property
+    def total_size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def lookup(self, doi, version):
+        """
+        Return the relative path of the stored file for this DOI and version,
+        or None if it has not been produced. A hit counts as serving the file.
+        """
+        key = self.key(doi, version)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and not os.path.isfile(os.path.join(self.root, entry['path'])):
+                log.warning('Stored file {0} has gone missing'.format(entry['path']))
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry['last_served'] = time.time()
+            self._save()
+        log.info('Output store hit for doi:{0} EPUB{1}'.format(doi, version))
+        return entry['path']
+
+    def has(self, doi, version):
+        """
+        True if a file is recorded for this DOI and version. Unlike `lookup`
+        this does not count as serving it.
+        """
+        return self.key(doi, version) in self.entries
+
+    def add(self, doi, version, path):
+        """
+        Record a newly produced file, then evict old files if over quota.
+        Returns the list of relative paths that were evicted.
+        """
+        size = os.path.getsize(os.path.join(self.root, path))
+        key = self.key(doi, version)
+        with self._lock:
+            self.entries[key] = {'path': path,
+                                 'size': size,
+                                 'last_served': time.time()}
+            evicted = self._evict(keep=key)
+            self._save()
+        return evicted
+
+    def report(self):
+        log.info('Output store: {0} files, {1} bytes, {2} hits, {3} misses, {4} evictions'.format(len(self.entries), self.total_size, self.hits, self.misses, self.evictions))
+
+    def _evict(self, keep=None):
+        evicted = []
+        if self.quota is None:
+            return evicted
+        total = self.total_size
+        by_age = sorted(self.entries.items(), key=lambda item: item[1]['last_served'])
+        for key, entry in by_age:
+            if total <= self.quota:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.root, entry['path']))
+            except FileNotFoundError:
+                pass
+            del self.entries[key]
+            total -= entry['size']
+            self.evictions += 1
+            evicted.append(entry['path'])
+            log.info('Evicted {0} ({1} bytes) from the output store'.format(entry['path'], entry['size']))
+        return evicted
+
+    def _load(self):
+        if not os.path.isfile(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path) as inf:
+                self.entries = json.load(inf)
+        except ValueError as e:
+            log.exception(e)
+            log.error('Output store manifest is corrupt, starting empty')
+            self.entries = {}
+
+    def _save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            json.dump(self.entries, out, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the ReplyPipeline, which decouples reading the submission
+stream from the slow work of replying to a post.
+
+The stream reader only filters and hands accepted posts to a bounded queue; a
+pool of worker threads takes posts off the queue and replies to them. When the
+queue is full the reader blocks, so a backlog cannot grow without limit.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+__all__ = ['ReplyPipeline']
+
+log = logging.getLogger('OA_source_bot.pipeline')
+
+_STOP = object()  # Sentinel telling a worker to exit
+
+
+class ReplyPipeline(object):
+    """
+    A bounded queue feeding a pool of worker threads, each of which calls
+    `handler(item)` for the items it receives.
+    """
+    def __init__(self, handler, workers=2, maxsize=50):
+        self.handler = handler
+        self.worker_count = max(1, workers)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.threads = []
+
+    def start(self):
+        if self.threads:
+            return
+        for i in range(self.worker_count):
+            thread = threading.Thread(target=self._work,
+                                      name='reply-worker-{0}'.format(i),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        log.info('Started {0} reply workers'.format(self.worker_count))
+
+    def submit(self, item):
+        """
+        Queue an item for the workers. Blocks while the queue is full.
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            log.warning('Reply queue is full, stream reader waiting on workers')
+            start = time.time()
+            self.queue.put(item)
+            log.info('Reply queue accepted post after {0:.1f}s'.format(time.time() - start))
+
+    def shutdown(self, drain=True):
+        """
+        Stop the workers. If `drain` is True, everything already queued is
+        handled first; otherwise pending items are discarded.
+        """
+        if not drain:
+            discarded = 0
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.queue.task_done()
+                discarded += 1
+            if discarded:
+                log.warning('Discarded {0} queued replies'.format(discarded))
+        log.info('Waiting on {0} queued replies'.format(self.queue.qsize()))
+        for thread in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self.handler(item)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                self.queue.task_done()
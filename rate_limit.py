@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the RequestScheduler, a priority-aware token bucket that
+every outbound reddit API request passes through.
+
+Requests take the priority of the code that makes them, set with the
+`priority` context manager (or decorator): replies and the submission stream
+come first, then mail, then review and backup work. When tokens are short,
+waiting requests are served strictly by priority, then in arrival order. The
+refill rate follows reddit's X-Ratelimit headers as responses arrive.
+
+ScheduledHandler plugs the scheduler into a praw session.
+"""
+
+from contextlib import contextmanager
+import heapq
+import itertools
+import logging
+from metrics import metrics
+from praw.handlers import DefaultHandler, RateLimitHandler
+import threading
+import time
+
+__all__ = ['MAIL', 'MAINTENANCE', 'REPLY', 'RequestScheduler',
+           'ScheduledHandler', 'priority']
+
+log = logging.getLogger('OA_source_bot.rate_limit')
+
+REPLY = 0
+MAIL = 1
+MAINTENANCE = 2
+PRIORITY_NAMES = {REPLY: 'reply', MAIL: 'mail', MAINTENANCE: 'maintenance'}
+
+_local = threading.local()
+
+
+@contextmanager
+def priority(level):
+    """
+    Requests made by this thread within the block take priority `level`. May
+    also be used as a decorator.
+    """
+    previous = getattr(_local, 'priority', None)
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    level = getattr(_local, 'priority', None)
+    return MAIL if level is None else level
+
+
+class RequestScheduler(object):
+    """
+    A token bucket refilled at `rate` tokens per second holding at most
+    `burst` tokens; each request takes one token.
+    """
+    def __init__(self, rate=0.5, burst=5):
+        self.rate = rate
+        self.default_rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self.requests = {level: 0 for level in PRIORITY_NAMES}
+        self.waited = {level: 0.0 for level in PRIORITY_NAMES}
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, level=None):
+        """
+        Block until a token is available to this request, serving higher
+        priorities (lower numbers) first. Returns the seconds waited.
+        """
+        level = current_priority() if level is None else level
+        start = time.monotonic()
+        with self._cond:
+            entry = (level, next(self._order))
+            heapq.heappush(self._waiters, entry)
+            metrics.set('api_queue_depth', len(self._waiters))
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if (self._waiters[0] == entry and self.tokens >= 1 and
+                            now >= self._paused_until):
+                        break
+                    if self._waiters[0] != entry:
+                        timeout = None  # Woken when those ahead are served
+                    elif now < self._paused_until:
+                        timeout = self._paused_until - now
+                    else:
+                        timeout = (1 - self.tokens) / self.rate
+                    self._cond.wait(timeout)
+                self.tokens -= 1
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                metrics.set('api_queue_depth', len(self._waiters))
+                self._cond.notify_all()
+        waited = time.monotonic() - start
+        self.requests[level] += 1
+        self.waited[level] += waited
+        metrics.observe('api_wait_seconds', waited, priority=PRIORITY_NAMES[level])
+        return waited
+
+    def observe_headers(self, headers):
+        """
+        Adjust the refill rate to spread the remaining allowance over the rest
+        of reddit's rate limit window, pausing if it is used up.
+        """
+        try:
+            remaining = float(headers['x-ratelimit-remaining'])
+            reset = float(headers['x-ratelimit-reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining < 1:
+                log.warning('API allowance used up, pausing {0:.0f}s'.format(reset))
+                self._paused_until = now + reset
+                self.tokens = 0.0
+            else:
+                self.rate = max(remaining / max(reset, 1.0), 0.01)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            depth = {}
+            for level, order in self._waiters:
+                depth[PRIORITY_NAMES[level]] = depth.get(PRIORITY_NAMES[level], 0) + 1
+            return {'rate': self.rate,
+                    'tokens': self.tokens,
+                    'queue_depth': depth,
+                    'requests': {PRIORITY_NAMES[k]: v for k, v in self.requests.items()},
+                    'waited_seconds': {PRIORITY_NAMES[k]: v for k, v in self.waited.items()}}
+
+    def report(self):
+        stats = self.stats()
+        log.info('API scheduler: rate {0:.2f}/s, {1:.1f} tokens, queued {2}'.format(stats['rate'], stats['tokens'], stats['queue_depth']))
+        for name in sorted(stats['requests']):
+            log.info('  {0}: {1} requests, {2:.1f}s waiting'.format(name, stats['requests'][name], stats['waited_seconds'][name]))
+
+
+class ScheduledHandler(DefaultHandler):
+    """
+    A praw handler that takes a token from `scheduler` before every request
+    sent to reddit, in place of praw's fixed delay between requests.
+    Responses served from praw's cache cost no token.
+
+    The bot's one praw session is used by the stream, the reply workers and
+    the scheduler thread. praw is not thread safe in general, but for a
+    cookie (password) login, as the bot uses, the state shared between
+    threads is limited to what this handler guards:
+
+    * the HTTP session, its connection pool and the login cookies, used only
+      while sending, which is done one request at a time
+    * praw's response cache, behind its own lock
+    * the session's modhash and user, set once by login before any write
+
+    The per-call OAuth flag praw toggles is only ever False without OAuth,
+    and content objects are not used by two threads at once: a post passes
+    from the stream to a single reply worker.
+    """
+    @staticmethod
+    def cache_hit_callback(cache_key):
+        metrics.inc('api_cache_hits_total')
+
+    def __init__(self, scheduler):
+        super(ScheduledHandler, self).__init__()
+        self.scheduler = scheduler
+        self._send_lock = threading.Lock()
+
+    def _send(self, **kwargs):
+        """
+        Send a request that missed the cache.
+        """
+        kwargs['_rate_delay'] = 0  # Pacing is the scheduler's job
+        self.scheduler.acquire()
+        with self._send_lock:
+            response = RateLimitHandler.request(self, **kwargs)
+        self.scheduler.observe_headers(response.headers)
+        return response
+
+#Look in praw's cache first, so that only requests actually sent take a token
+ScheduledHandler.request = DefaultHandler.with_cache(ScheduledHandler._send)
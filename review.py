@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the ReviewIndex, a local record of the bot's own comments
+and when each is next due to be checked.
+
+Comments are re-checked often while they are new and rarely once they are
+old, and are forgotten entirely after a cutoff, so a review cycle never has to
+walk the bot's whole comment history. Each comment also records the post it
+replies to, so the bot's reply to a post is found without listing the post's
+comments.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+__all__ = ['ReviewIndex']
+
+log = logging.getLogger('OA_source_bot.review')
+
+
+class ReviewIndex(object):
+    """
+    Tracks comment IDs with their creation time, next check time and the ID
+    of the post replied to, persisted as JSON in `path`.
+
+    `schedule` is a sequence of (age, interval) pairs: a comment younger than
+    `age` seconds is re-checked every `interval` seconds. Comments older than
+    `cutoff` seconds are dropped.
+
+    Tracking and forgetting comments only marks the index as changed; it is
+    written by `checked` and `save`, so a burst of changes costs one write.
+    """
+    schedule = ((3600, 300),             # First hour, every 5 minutes
+                (24 * 3600, 3600),       # First day, hourly
+                (7 * 24 * 3600, 6 * 3600))  # First week, every 6 hours
+
+    def __init__(self, path, cutoff=7 * 24 * 3600):
+        self.path = path
+        self.cutoff = cutoff
+        self.comments = {}  # comment id -> [created, next_check, post id]
+        self._lock = threading.Lock()
+        self.loaded = self._load()
+        #An index not read from disk is written by the first save, even empty
+        self._dirty = not self.loaded
+
+    def __len__(self):
+        return len(self.comments)
+
+    def __contains__(self, comment_id):
+        return comment_id in self.comments
+
+    def interval(self, age):
+        for limit, interval in self.schedule:
+            if age < limit:
+                return interval
+        return None
+
+    def track(self, comment_id, created=None, post_id=None):
+        created = time.time() if created is None else created
+        with self._lock:
+            self.comments[comment_id] = [created, created + self.interval(0), post_id]
+            self._dirty = True
+
+    def comment_for(self, post_id):
+        """
+        Returns the ID of the tracked comment replying to `post_id`, or None.
+        """
+        with self._lock:
+            for comment_id, entry in self.comments.items():
+                #Indexes written before post IDs were kept have two fields
+                if entry[2:] == [post_id]:
+                    return comment_id
+        return None
+
+    def forget(self, comment_id):
+        with self._lock:
+            if self.comments.pop(comment_id, None) is not None:
+                self._dirty = True
+
+    def age(self, comment_id, now=None):
+        now = time.time() if now is None else now
+        return now - self.comments[comment_id][0]
+
+    def due(self, limit, now=None):
+        """
+        Return up to `limit` comment IDs whose check is due, most overdue
+        first. Comments past the cutoff are dropped.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for comment_id, entry in list(self.comments.items()):
+                if now - entry[0] > self.cutoff:
+                    del self.comments[comment_id]
+                    self._dirty = True
+            due = [(entry[1], comment_id)
+                   for comment_id, entry in self.comments.items()
+                   if entry[1] <= now]
+        due.sort()
+        return [comment_id for next_check, comment_id in due[:limit]]
+
+    def checked(self, comment_ids, now=None):
+        """
+        Schedule the next check of each of `comment_ids` by its age.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for comment_id in comment_ids:
+                entry = self.comments.get(comment_id)
+                if entry is None:
+                    continue
+                interval = self.interval(now - entry[0])
+                if interval is None:
+                    del self.comments[comment_id]
+                else:
+                    entry[1] = now + interval
+            self._save()
+
+    def save(self):
+        """
+        Write the index if it has changed since it was last written.
+        """
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path) as inf:
+                self.comments = json.load(inf)
+        except ValueError as e:
+            log.exception(e)
+            log.error('Review index is corrupt, starting empty')
+            self.comments = {}
+            return False
+        return True
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            json.dump(self.comments, out)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
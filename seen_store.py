@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the SeenStore, the record of submissions that the bot has
+already handled.
+
+Reddit IDs are base36 strings, so they are packed into integers for storage.
+Every addition is appended to a journal file as a fixed-size binary record, so
+a crash loses nothing that was already added. The journal is periodically
+compacted, dropping entries that have fallen outside the retention window.
+"""
+
+from collections import OrderedDict
+import logging
+import os
+import struct
+import threading
+import time
+
+__all__ = ['SeenStore']
+
+log = logging.getLogger('OA_source_bot.seen_store')
+
+
+class SeenStore(object):
+    """
+    A set-like record of post IDs with O(1) membership and an append-only
+    on-disk journal.
+
+    Entries older than `retention` seconds are expired. The journal is
+    rewritten once it holds more than `compact_ratio` times as many records as
+    there are live entries.
+    """
+    #Post ID as unsigned 64 bit integer, time seen as a double
+    record = struct.Struct('<Qd')
+
+    def __init__(self, path, retention=7 * 24 * 3600, compact_ratio=4,
+                 legacy_path='already_seen'):
+        self.path = path
+        self.retention = retention
+        self.compact_ratio = compact_ratio
+        self._seen = OrderedDict()  # Insertion order is also age order
+        self._journal_records = 0
+        self._lock = threading.Lock()
+        self._load()
+        if legacy_path is not None and os.path.isfile(legacy_path):
+            self._import_legacy(legacy_path)
+        self._journal = open(self.path, 'ab')
+
+    @staticmethod
+    def pack_id(post_id):
+        return int(post_id, 36)
+
+    @staticmethod
+    def unpack_id(number):
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+        chars = []
+        while True:
+            number, rem = divmod(number, 36)
+            chars.append(digits[rem])
+            if not number:
+                break
+        return ''.join(reversed(chars))
+
+    def __contains__(self, post_id):
+        return self.pack_id(post_id) in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __iter__(self):
+        return (self.unpack_id(key) for key in list(self._seen))
+
+    def add(self, post_id, when=None):
+        """
+        Record a post ID as seen and journal it immediately. Returns False if
+        the ID was already present.
+        """
+        key = self.pack_id(post_id)
+        when = time.time() if when is None else when
+        with self._lock:
+            if key in self._seen:
+                return False
+            self._seen[key] = when
+            self._journal.write(self.record.pack(key, when))
+            self._journal.flush()
+            self._journal_records += 1
+            self._expire(when)
+            if self._journal_records > self.compact_ratio * max(len(self._seen), 1000):
+                self._compact()
+        return True
+
+    def expire(self, now=None):
+        with self._lock:
+            self._expire(time.time() if now is None else now)
+
+    def compact(self):
+        """
+        Rewrite the journal so that it holds only the live entries.
+        """
+        with self._lock:
+            self._expire(time.time())
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            self._journal.close()
+
+    def _expire(self, now):
+        cutoff = now - self.retention
+        while self._seen:
+            key, when = next(iter(self._seen.items()))
+            if when >= cutoff:
+                break
+            self._seen.popitem(last=False)
+
+    def _compact(self):
+        log.debug('Compacting seen store, {0} journal records for {1} entries'.format(self._journal_records, len(self._seen)))
+        self._journal.close()
+        self._write_snapshot()
+        self._journal = open(self.path, 'ab')
+
+    def _write_snapshot(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as out:
+            for key, when in self._seen.items():
+                out.write(self.record.pack(key, when))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.path)
+        self._journal_records = len(self._seen)
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        size = self.record.size
+        with open(self.path, 'rb') as inf:
+            data = inf.read()
+        #A crash mid-write may leave a truncated record at the end; ignore it
+        usable = len(data) - len(data) % size
+        for key, when in self.record.iter_unpack(data[:usable]):
+            self._seen.pop(key, None)
+            self._seen[key] = when
+            self._journal_records += 1
+        if usable != len(data):
+            log.warning('Discarding truncated record at end of {0}'.format(self.path))
+            with open(self.path, 'r+b') as out:
+                out.truncate(usable)
+        self._expire(time.time())
+        log.info('Loaded {0} seen posts from {1}'.format(len(self._seen), self.path))
+
+    def _import_legacy(self, legacy_path):
+        """
+        Import the plain text record written by older versions of the bot.
+        """
+        now = time.time()
+        count = 0
+        with open(legacy_path) as inf:
+            for line in inf:
+                post_id = line.strip()
+                if not post_id:
+                    continue
+                key = self.pack_id(post_id)
+                if key not in self._seen:
+                    self._seen[key] = now
+                    count += 1
+        log.info('Imported {0} posts from legacy file {1}'.format(count, legacy_path))
+        self._write_snapshot()
+        os.rename(legacy_path, legacy_path + '.imported')
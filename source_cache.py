@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the SourceCache, a bounded local cache of the article XML
+that EPUBs are made from, keyed by DOI.
+
+Each source is stored whole as a plain file, so it can be handed to the
+converter by path or memory-mapped, and the least recently used sources are
+evicted to stay under a byte quota. Sources can be prefetched on a small pool
+of threads as soon as a post is accepted, so the download overlaps the reddit
+requests made while replying; a conversion then waits for the prefetch rather
+than downloading the article again.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from domains import download
+import hashlib
+import http.client
+import json
+import logging
+from metrics import metrics
+import os
+import threading
+import time
+
+__all__ = ['SourceCache']
+
+log = logging.getLogger('OA_source_bot.source_cache')
+
+
+class SourceCache(object):
+    """
+    Article sources stored under `root`, with a manifest persisted as JSON in
+    `manifest_path`. `quota` is in bytes; None means unbounded.
+    """
+    def __init__(self, root, quota=None, manifest_path=None, workers=2,
+                 timeout=60):
+        self.root = root
+        self.quota = quota
+        self.manifest_path = manifest_path or os.path.join(root, 'manifest.json')
+        self.timeout = timeout
+        self.entries = {}  # doi -> {'path', 'size', 'last_used'}
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self._pending = {}  # doi -> Future of a fetch in progress
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='source-prefetch')
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def filename(doi):
+        return hashlib.sha1(doi.encode('utf-8')).hexdigest() + '.xml'
+
+    @property
+    def total_size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def prefetch(self, doi, url):
+        """
+        Start fetching the source of `doi` from `url` in the background,
+        unless it is cached or already being fetched.
+        """
+        with self._lock:
+            if doi in self.entries or doi in self._pending:
+                return
+            self._pending[doi] = self._pool.submit(self._fetch, doi, url)
+
+    def get(self, doi, url=None):
+        """
+        Returns the path of the cached source of `doi`, waiting on a prefetch
+        in progress, or fetching it now from `url` if given. Returns None if
+        the source is not available.
+
+        The first use of a prefetched source counts as a prefetch rather than
+        a hit; only later uses save a download.
+        """
+        with self._lock:
+            future = self._pending.get(doi)
+            entry = self.entries.get(doi)
+            if entry is not None and future is None:
+                path = os.path.join(self.root, entry['path'])
+                if os.path.isfile(path):
+                    if entry.pop('fresh', False):
+                        self.prefetched += 1
+                        metrics.inc('source_cache_total', result='prefetch')
+                    else:
+                        self.hits += 1
+                        self.bytes_saved += entry['size']
+                        metrics.inc('source_cache_total', result='hit')
+                        metrics.inc('source_cache_bytes_saved_total', entry['size'])
+                    entry['last_used'] = time.time()
+                    self._save()
+                    return path
+                log.warning('Cached source {0} has gone missing'.format(entry['path']))
+                del self.entries[doi]
+            if future is not None:
+                self.prefetched += 1
+                metrics.inc('source_cache_total', result='prefetch')
+            else:
+                self.misses += 1
+                metrics.inc('source_cache_total', result='miss')
+                if url is not None:
+                    future = self._pending[doi] = self._pool.submit(self._fetch, doi, url)
+        if future is None:
+            return None
+        try:
+            path = future.result(timeout=self.timeout)
+        except Exception as e:
+            log.exception(e)
+            return None
+        with self._lock:
+            entry = self.entries.get(doi)
+            if entry is not None:
+                entry.pop('fresh', None)
+        return path
+
+    def report(self):
+        uses = self.hits + self.misses + self.prefetched
+        hit_rate = self.hits / uses if uses else 0.0
+        log.info('Source cache: {0} files, {1} bytes, {2} hits ({3:.0%}), {4} prefetched, {5} misses, {6} bytes saved, {7} evictions'.format(len(self.entries), self.total_size, self.hits, hit_rate, self.prefetched, self.misses, self.bytes_saved, self.evictions))
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def _fetch(self, doi, url):
+        name = self.filename(doi)
+        path = os.path.join(self.root, name)
+        tmp_path = path + '.tmp'
+        try:
+            with metrics.timer('stage_seconds', stage='source_fetch'):
+                with open(tmp_path, 'wb') as out:
+                    size = download(url, out, timeout=self.timeout)
+            os.replace(tmp_path, path)
+        except (http.client.HTTPException, OSError) as e:
+            log.exception(e)
+            log.error('Unable to fetch the source of doi:{0}'.format(doi))
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self._pending.pop(doi, None)
+            return None
+        with self._lock:
+            self._pending.pop(doi, None)
+            self.entries[doi] = {'path': name, 'size': size,
+                                 'last_used': time.time(), 'fresh': True}
+            self._evict(keep=doi)
+            self._save()
+        log.debug('Cached source of doi:{0}, {1} bytes'.format(doi, size))
+        return path
+
+    def _evict(self, keep=None):
+        if self.quota is None:
+            return
+        total = self.total_size
+        by_age = sorted(self.entries.items(), key=lambda item: item[1]['last_used'])
+        for doi, entry in by_age:
+            if total <= self.quota:
+                break
+            if doi == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.root, entry['path']))
+            except FileNotFoundError:
+                pass
+            del self.entries[doi]
+            total -= entry['size']
+            self.evictions += 1
+            log.debug('Evicted the source of doi:{0} ({1} bytes)'.format(doi, entry['size']))
+
+    def _load(self):
+        if not os.path.isfile(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path) as inf:
+                self.entries = json.load(inf)
+        except ValueError as e:
+            log.exception(e)
+            log.error('Source cache manifest is corrupt, starting empty')
+            self.entries = {}
+
+    def _save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            json.dump(self.entries, out, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
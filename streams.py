@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the MultiredditStream, a source of new submissions that
+polls only the watched subreddits instead of filtering all of /r/all.
+
+The watched subreddits are split into multireddit groups ('a+b+c') short
+enough to keep request URLs safe. Groups are polled in round-robin, their
+results are merged and deduplicated, and the groups are rebuilt whenever the
+watched set changes. A periodic sweep pages back through /r/all to the time
+of the previous sweep, catching anything the multireddit listings were late
+to show.
+
+Polls are made one after another: every request goes through the same rate
+limited session, so polling groups concurrently would not fetch any faster.
+"""
+
+from collections import OrderedDict
+import logging
+import time
+
+__all__ = ['MultiredditStream', 'chunk_subreddits']
+
+log = logging.getLogger('OA_source_bot.streams')
+
+
+def chunk_subreddits(names, max_length=1500):
+    """
+    Split subreddit names into groups whose '+'-joined length does not exceed
+    `max_length`. Names are sorted so that the grouping is stable.
+    """
+    groups = []
+    current = []
+    length = 0
+    for name in sorted(name for name in names if name):
+        extra = len(name) + (1 if current else 0)
+        if current and length + extra > max_length:
+            groups.append('+'.join(current))
+            current = []
+            extra = len(name)
+            length = 0
+        current.append(name)
+        length += extra
+    if current:
+        groups.append('+'.join(current))
+    return groups
+
+
+class MultiredditStream(object):
+    """
+    Iterating over this yields new submissions from the subreddits returned by
+    `get_watched()`, each at most once.
+
+    Groups are polled in turn, spread so that a full round takes at least
+    `poll_interval` seconds; the `sweep_subreddit` is added to a round every
+    `sweep_interval` seconds, and swept back to the previous sweep, a round
+    earlier still for margin, in up to `sweep_pages` listing pages.
+    """
+    def __init__(self, reddit, get_watched, max_length=1500, poll_interval=30,
+                 sweep_interval=600, sweep_subreddit='all', limit=100,
+                 remember=10000, sweep_pages=10):
+        self.reddit = reddit
+        self.get_watched = get_watched
+        self.max_length = max_length
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self.sweep_subreddit = sweep_subreddit
+        self.limit = limit
+        self.remember = remember
+        self.sweep_pages = sweep_pages
+        self.groups = []
+        self._watched = None
+        self._recent = OrderedDict()
+        self._last_sweep = time.monotonic()
+        self._last_sweep_utc = time.time()
+        self.requests = 0
+
+    def rebalance(self):
+        """
+        Rebuild the multireddit groups if the watched set has changed.
+        """
+        watched = frozenset(self.get_watched())
+        if watched == self._watched:
+            return
+        self._watched = watched
+        self.groups = chunk_subreddits(watched, self.max_length)
+        log.info('Streaming {0} subreddits in {1} multireddit groups'.format(len(watched), len(self.groups)))
+
+    def poll(self, subreddit):
+        """
+        Return the unseen submissions among the newest in `subreddit`.
+        """
+        self.requests += 1
+        return self._unseen(self.reddit.get_subreddit(subreddit).get_new(limit=self.limit))
+
+    def sweep(self):
+        """
+        Return the unseen submissions in the `sweep_subreddit` made since the
+        previous sweep, paging back through its listing.
+        """
+        since = self._last_sweep_utc - self.poll_interval
+        self._last_sweep_utc = time.time()
+        listing = self.reddit.get_subreddit(self.sweep_subreddit)
+        fresh = []
+        after = None
+        for page in range(self.sweep_pages):
+            self.requests += 1
+            params = {} if after is None else {'after': after}
+            posts = list(listing.get_new(limit=self.limit, params=params))
+            in_range = [post for post in posts if post.created_utc >= since]
+            fresh.extend(self._unseen(in_range))
+            if len(in_range) < len(posts) or len(posts) < self.limit:
+                return fresh
+            after = posts[-1].fullname
+        log.info('Sweep of /r/{0} stopped after {1} pages short of the previous sweep'.format(self.sweep_subreddit, self.sweep_pages))
+        return fresh
+
+    def _unseen(self, posts):
+        fresh = []
+        for post in posts:
+            if post.id in self._recent:
+                continue
+            self._recent[post.id] = None
+            fresh.append(post)
+        while len(self._recent) > self.remember:
+            self._recent.popitem(last=False)
+        return fresh
+
+    def __iter__(self):
+        while True:
+            self.rebalance()
+            targets = [(self.poll, group) for group in self.groups]
+            if time.monotonic() - self._last_sweep >= self.sweep_interval:
+                targets.append((self.sweep, None))
+                self._last_sweep = time.monotonic()
+            if not targets:
+                time.sleep(self.poll_interval)
+                continue
+            #Spread the polls evenly over the round
+            pause = self.poll_interval / len(targets)
+            for poll, target in targets:
+                poll_start = time.monotonic()
+                fresh = poll() if target is None else poll(target)
+                fresh.sort(key=lambda post: post.created_utc)
+                for post in fresh:
+                    yield post
+                remaining = pause - (time.monotonic() - poll_start)
+                if remaining > 0:
+                    time.sleep(remaining)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines the WikiList, a set of names that is published to one of
+the bot's wikipages, such as the ignored users or the watched subreddits.
+
+Changes mark the list dirty; a flush writes the page only once the list has
+been quiet for a debounce window, so a burst of changes costs one write. The
+published content is sorted, so it is deterministic, and a write is skipped
+when its hash matches the last published revision. If a write fails the
+content is saved to a local file, which is picked up on the next start and
+removed once a write succeeds.
+
+The last-known list is also kept in a local snapshot, so that the bot can
+start with it straight away and reconcile with the wikipage afterwards.
+Changes made before reconciling are replayed onto the wikipage's content,
+and nothing is published until then.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+__all__ = ['WikiList']
+
+log = logging.getLogger('OA_source_bot.wiki_lists')
+
+
+class WikiList(object):
+    """
+    A set-like collection of names backed by the wikipage `page` of the
+    subreddit or user `owner`, with `local_path` as its fallback file and
+    `snapshot_path` (by default `local_path` + '.snapshot') as its snapshot.
+    """
+    def __init__(self, name, owner, page, local_path, debounce=60,
+                 snapshot_path=None):
+        self.name = name
+        self.owner = owner
+        self.page = page
+        self.local_path = local_path
+        self.snapshot_path = snapshot_path or local_path + '.snapshot'
+        self.debounce = debounce
+        self.items = set()
+        self.dirty = False
+        self.published_hash = None
+        self.reconciled = False
+        self._pending = []  # Changes made before reconciling
+        self._last_change = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def parse(content):
+        return set(line.strip() for line in content.split('\n') if line.strip())
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def content(self):
+        with self._lock:
+            return '\n'.join(['    ' + item for item in sorted(self.items)])
+
+    def restore(self):
+        """
+        Restore the list from the local fallback file or snapshot without
+        contacting reddit. Returns False if there is neither.
+        """
+        with self._lock:
+            for path in (self.local_path, self.snapshot_path):
+                if os.path.isfile(path):
+                    with open(path) as inf:
+                        self.items = self.parse(inf.read())
+                    log.info('Restored {0} {1} from {2}'.format(len(self.items), self.name, path))
+                    return True
+        return False
+
+    def load(self, reddit):
+        """
+        Load the list from the wikipage, reconciling it with any changes made
+        since `restore`. A local fallback file left by a failed write is newer
+        than the wikipage, so it is preferred.
+        """
+        wikipage = reddit.get_wiki_page(self.owner, self.page)
+        content = wikipage.content_md
+        with self._lock:
+            self.items = self.parse(content)
+            self.published_hash = self.digest(content)
+            changed = bool(self._pending)
+            if os.path.isfile(self.local_path):
+                log.info('Found unpublished {0} in {1}'.format(self.name, self.local_path))
+                with open(self.local_path) as inf:
+                    self.items = self.parse(inf.read())
+                changed = True
+            for method, item in self._pending:
+                getattr(self.items, method)(item)
+            self._pending = []
+            self.reconciled = True
+            if changed:
+                self._mark_dirty()
+            self._write_snapshot(content)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        with self._lock:
+            return iter(sorted(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        with self._lock:
+            if item not in self.items:
+                self.items.add(item)
+                self._mark_dirty()
+                if not self.reconciled:
+                    self._pending.append(('add', item))
+
+    def remove(self, item):
+        with self._lock:
+            self.items.remove(item)
+            self._mark_dirty()
+            if not self.reconciled:
+                self._pending.append(('discard', item))
+
+    def discard(self, item):
+        with self._lock:
+            if item in self.items:
+                self.remove(item)
+
+    def _mark_dirty(self):
+        self.dirty = True
+        self._last_change = time.monotonic()
+
+    def flush(self, reddit, immediate=False):
+        """
+        Publish the list if it is dirty and has been quiet for the debounce
+        window, or regardless of the window if `immediate`. Returns True if
+        the wikipage was written. Nothing is published before the list has
+        been reconciled with the wikipage; an immediate flush saves it to the
+        fallback file instead.
+        """
+        with self._lock:
+            if not self.dirty:
+                return False
+            if not self.reconciled:
+                if immediate:
+                    self._save_local(self.content())
+                return False
+            if not immediate and time.monotonic() - self._last_change < self.debounce:
+                return False
+            content = self.content()
+            digest = self.digest(content)
+            if digest == self.published_hash:
+                log.debug('{0} unchanged since last published, skipping write'.format(self.name))
+                self.dirty = False
+                self._remove_local()
+                return False
+            log.info('Writing the list of {0} to the wikipage'.format(self.name))
+            try:
+                wikipage = reddit.get_wiki_page(self.owner, self.page)
+                wikipage.edit(content)
+            except Exception as e:
+                log.exception(e)
+                log.info('An error occurred while writing wikipage! Writing to file instead.')
+                self._save_local(content)
+                return False
+            self.published_hash = digest
+            self.dirty = False
+            self._remove_local()
+            self._write_snapshot(content)
+            return True
+
+    def _save_local(self, content):
+        with open(self.local_path, 'w') as out:
+            out.write(content)
+
+    def _write_snapshot(self, content):
+        tmp_path = self.snapshot_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as out:
+                out.write(content)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            log.exception(e)
+
+    def _remove_local(self):
+        if os.path.isfile(self.local_path):
+            log.info('Reconciled {0} with the wikipage, removing {1}'.format(self.name, self.local_path))
+            os.remove(self.local_path)